@@ -0,0 +1,101 @@
+import instrument
+
+# the arrow engine reads the reports with pyarrow, which parses a file on
+# several threads and sums up groups without making a python object for
+# every row. pyarrow is optional, without it the reports are read with the
+# csv module like before
+
+# so we only complain once about pyarrow missing
+warned = False
+
+
+# the engine option of a store section, unless it asks for arrow and pyarrow
+# isn't installed, then it's csv
+def engine(config):
+    global warned
+
+    engine = config.get('engine', 'csv')
+    if engine == 'arrow' and not available():
+        if not warned:
+            print('⚠️ pyarrow is not installed, reading the reports with the csv module instead')
+            warned = True
+        return 'csv'
+    return engine
+
+
+def available():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+# reads the given columns of all files (opened as bytes) into one table,
+# everything is kept as strings so amounts can be parsed exactly, see
+# decimals. if end is given, a file stops at the first line that starts with it
+def readTable(files, columns, delimiter=',', end=None):
+    import pyarrow
+    import pyarrow.csv
+
+    # product titles can have line breaks in them, inside quotes. without
+    # newlines_in_values arrow splits the file into blocks at any line break
+    parseOptions = pyarrow.csv.ParseOptions(delimiter=delimiter, newlines_in_values=True)
+    convertOptions = pyarrow.csv.ConvertOptions(include_columns=columns,
+                                                column_types={column: pyarrow.string() for column in columns},
+                                                strings_can_be_null=False)
+
+    tables = []
+    for source in files:
+        if end is not None:
+            data = source.read()
+            cut = data.find(b'\n' + end)
+            if cut != -1:
+                data = data[:cut + 1]
+            source = pyarrow.BufferReader(data)
+
+        tables.append(pyarrow.csv.read_csv(source, parse_options=parseOptions, convert_options=convertOptions))
+
+    table = pyarrow.concat_tables(tables)
+    instrument.current().rows += table.num_rows
+    return table
+
+
+# turns a column of decimal strings into exact decimals, all with as many
+# decimals as the longest one has, so they can be summed without floats
+def decimals(column):
+    import pyarrow
+    import pyarrow.compute as pc
+
+    column = pc.utf8_trim_whitespace(column)
+    dot = pc.find_substring(column, '.')
+    places = pc.if_else(pc.less(dot, 0), 0, pc.subtract(pc.subtract(pc.utf8_length(column), dot), 1))
+    return pc.cast(column, pyarrow.decimal128(38, pc.max(places).as_py() or 0))
+
+
+# sums up the amount column of a table, grouped on the key columns, in the
+# order the groups first appear. the count is the sum of the counts column,
+# or the number of rows if there is none. yields (keys, amount, count) with
+# the amount as a Decimal
+def totals(table, keys, amount, counts=None):
+    import pyarrow
+    import pyarrow.compute as pc
+
+    if table.num_rows == 0:
+        return
+
+    columns = {key: table[key] for key in keys}
+    columns['amount'] = decimals(table[amount])
+    # the number of every row, the groups are sorted on the first one
+    columns['row'] = pc.cumulative_sum(pyarrow.repeat(1, table.num_rows))
+    aggregations = [('row', 'min'), ('amount', 'sum')]
+    if counts is not None:
+        columns['count'] = pc.cast(pc.utf8_trim_whitespace(table[counts]), pyarrow.int64())
+        aggregations.append(('count', 'sum'))
+    else:
+        aggregations.append((keys[0], 'count'))
+
+    grouped = pyarrow.table(columns).group_by(keys).aggregate(aggregations).sort_by('row_min')
+    names = list(keys) + ['amount_sum', 'count_sum' if counts is not None else f'{keys[0]}_count']
+    for row in zip(*(grouped[name].to_pylist() for name in names)):
+        yield tuple(row[:len(keys)]), row[-2], row[-1]
@@ -0,0 +1,130 @@
+import importlib
+from typing import NamedTuple
+
+
+# a store we can fetch reports from. the module behind it is only imported
+# once it's needed, so a run with one store enabled doesn't pay for importing
+# the others (and pandas, and the app store api)
+#
+# every store module provides the same interface:
+#   fetch(section, dates, ready)   downloads whatever is missing for the months
+#                                  and calls ready(date) as each one is done
+#   parseMonth(section, date, ...) parses one month into a report, or None
+#   aggregateMonth(section, date)  the numbers behind that report, or None
+#   inputPaths(section, date)      the files that month is parsed from
+#   rollup(months, period, ...)    one report for the aggregates of many months
+# and may provide
+#   parseStream(section, dates, run, ...)  the reports for a stream of months,
+#                                  for stores that don't parse a task per month
+#   provisional(section, date)     whether a month's report may still change
+# and the reports it returns have a render() that turns them into text
+class Backend(NamedTuple):
+    # also the name of the output folder
+    name: str
+    # printed when the store starts fetching
+    title: str
+    module: str
+    # the config section for the store, and the option in it that enables it
+    section: str
+    option: str
+    # any other config sections parseMonth needs, passed after the date
+    extra: tuple = ()
+    # the account, see utils.account, '' for the one without a name
+    account: str = ''
+
+    # the same store for a named account, with its own section
+    def forAccount(self, account):
+        if account == '':
+            return self
+        return self._replace(name=f'{account}/{self.name}', title=f'{self.title} ({account})',
+                             section=f'{self.section}:{account}', account=account)
+
+    def enabled(self, config):
+        return config.has_section(self.section) and config[self.section].get(self.option) == 'true'
+
+    def load(self):
+        return importlib.import_module(self.module)
+
+    # ready, if given, is called with each month once it has been fetched
+    def fetch(self, config, dates, ready=None):
+        self.load().fetch(config[self.section], dates, ready)
+
+    # the function and arguments that parse a month, kept apart so the
+    # call can be sent to another process
+    def task(self, config, date):
+        arguments = (config[self.section], date) + tuple(config[extra] for extra in self.extra)
+        return self.load().parseMonth, arguments
+
+    # the files the month is parsed from
+    def sources(self, config, date):
+        return self.load().inputPaths(config[self.section], date)
+
+    # the aggregates for a month, or None if it has no data
+    def aggregates(self, config, date):
+        return self.load().aggregateMonth(config[self.section], date)
+
+    # whether the report for a month may still change, see utils.Report
+    def provisional(self, config, date):
+        module = self.load()
+        return hasattr(module, 'provisional') and module.provisional(config[self.section], date)
+
+    # a single report for the aggregates of several months, see rollups
+    def rollup(self, config, months, period):
+        return self.load().rollup(months, period, *(config[extra] for extra in self.extra))
+
+    # (date, function, arguments) for every month, made as they are asked for
+    def tasks(self, config, dates):
+        for date in dates:
+            yield (date,) + self.task(config, date)
+
+    # (month, report) for every month with data, run parses a stream of tasks
+    # and gives back (month, result) for each, see taxman.parseAll
+    def reports(self, config, dates, run):
+        module = self.load()
+        if hasattr(module, 'parseStream'):
+            extra = tuple(config[extra] for extra in self.extra)
+            return module.parseStream(config[self.section], dates, run, *extra)
+        return run(self.tasks(config, dates))
+
+
+backends = [
+    Backend('app store', 'iTunes Connect', 'itunes', 'appstore', 'enabled'),
+    Backend('google play store', 'Google Play', 'googleplay', 'google', 'enabled'),
+    Backend('google play pass', 'Google Play Pass', 'googleplaypass', 'google', 'play_pass_enabled', ('packages',)),
+]
+
+
+def get(name):
+    for backend in backends:
+        if backend.name == name:
+            return backend
+    raise KeyError(name)
+
+
+# every store for every account that has a section in the config
+def accounts(config):
+    output = []
+    for backend in backends:
+        for section in config.sections():
+            base, colon, account = section.partition(':')
+            if base == backend.section:
+                output.append(backend.forAccount(account))
+    return output
+
+
+def enabled(config):
+    return [backend for backend in accounts(config) if backend.enabled(config)]
+
+
+# the google play store and play pass of every account that has both enabled,
+# as (name, store, playpass). their reports are merged into one, under name
+def merged(enabled):
+    output = []
+    for store in enabled:
+        if store.module != 'googleplay':
+            continue
+        for playpass in enabled:
+            if playpass.module == 'googleplaypass' and playpass.account == store.account:
+                name = f'{store.account}/google play' if store.account != '' else 'google play'
+                output.append((name, store, playpass))
+    return output
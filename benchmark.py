@@ -0,0 +1,619 @@
+import argparse
+import configparser
+import csv
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from datetime import datetime
+
+# the benchmarks run in a scratch folder, so the store modules need to be
+# importable from here no matter where we are run from
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cache
+import googleplay
+import googleplaypass
+import itunes
+from utils import TaxMonth
+from utils import Accumulator
+from utils import TransactionCollection
+from decimal import Decimal
+
+date = TaxMonth('2023', '01')
+month_names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+currencies = ['USD', 'EUR', 'SEK', 'GBP', 'JPY', 'AUD', 'CAD', 'NOK', 'DKK', 'CHF']
+
+google_columns = [
+    'Description', 'Transaction Date', 'Transaction Time', 'Tax Type', 'Transaction Type',
+    'Refund Type', 'Product Title', 'Product id', 'Product Type', 'Sku Id', 'Hardware',
+    'Buyer Country', 'Buyer State', 'Buyer Postal Code', 'Buyer Currency',
+    'Amount (Buyer Currency)', 'Currency Conversion Rate', 'Merchant Currency',
+    'Amount (Merchant Currency)']
+
+# roughly the mix of transaction types in a real report
+google_types = ['Charge'] * 6 + ['Google fee'] * 6 + ['Tax'] * 3 + ['Charge refund', 'Google fee refund']
+
+playpass_columns = [
+    'Transaction Date', 'Transaction Type', 'Product Id', 'Product Title',
+    'Amount (Merchant Currency)', 'Merchant Currency']
+
+apple_columns = [
+    'Start Date', 'End Date', 'UPC', 'ISRC/ISBN', 'Vendor Identifier', 'Quantity',
+    'Partner Share', 'Extended Partner Share', 'Partner Share Currency', 'Customer Price',
+    'Customer Currency', 'Country Of Sale', 'Apple Identifier', 'Artist/Show/Developer/Author',
+    'Title', 'Label/Studio/Network/Developer/Publisher', 'Grid', 'Product Type Identifier',
+    'ISAN/Other Identifier', 'Pre-order Flag', 'Promo Code']
+
+
+# with multiline, every other name has a line break in it, the stores quote
+# those like any other field
+def productNames(count, multiline=False):
+    if multiline:
+        return [f'Product {index:04d}' + ('\nDeluxe Edition' if index % 2 else '') for index in range(count)]
+    return [f'Product {index:04d}' for index in range(count)]
+
+
+# writes a google play earnings month split over several files, both as the
+# extracted csv files and as the zips they came in
+def generateGoogle(rows, products, files, date=date, folder='tmp', multiline=False):
+    names = productNames(products, multiline)
+    paths = []
+
+    for idx in range(files):
+        path = os.path.join(folder, f'earnings{date.year}{date.month}-{idx}.csv')
+        with open(path, 'w', encoding='utf8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(google_columns)
+            for row in range(idx, rows, files):
+                transactionType = random.choice(google_types)
+                # taxes are sometimes booked without a product
+                product = random.choice(names) if transactionType != 'Tax' or row % 4 else ''
+                amount = f'{random.uniform(-2, 40):.2f}'
+                writer.writerow([
+                    f'GPA.{row:020d}', f'{month_names[int(date.month) - 1]} {random.randint(1, 28)}, {date.year}',
+                    '1:23:45 PM PDT', '', transactionType, '', product, f'com.example.{product[8:12]}',
+                    'inapp', '', '', 'SE', '', '', 'SEK', amount, '1.000000', 'SEK', amount])
+
+        with zipfile.ZipFile(os.path.join(folder, f'earnings_{date.year}{date.month}_{idx}.zip'), 'w',
+                             zipfile.ZIP_DEFLATED) as zfile:
+            zfile.write(path, f'PlayApps_{date.year}{date.month}.csv')
+
+        paths.append(path)
+
+    return paths
+
+
+def generatePlayPass(rows, products, date=date, folder='tmp', multiline=False):
+    names = productNames(products, multiline)
+    path = os.path.join(folder, f'play_pass_earnings{date.year}{date.month}-0.csv')
+
+    with open(path, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(playpass_columns)
+        for row in range(rows):
+            product = random.choice(names)
+            writer.writerow([
+                f'{date.year}-{date.month}-{random.randint(1, 28):02d}',
+                random.choice(['Play Pass revenue', 'Play Pass revenue', 'Tax']),
+                f'com.example.{product[8:12]}', product, f'{random.uniform(0, 5):.6f}', 'SEK'])
+
+    with zipfile.ZipFile(os.path.join(folder, f'play_pass_earnings_{date.year}{date.month}_0.zip'), 'w',
+                         zipfile.ZIP_DEFLATED) as zfile:
+        zfile.write(path, f'PlayPass_{date.year}{date.month}.csv')
+
+    return [path]
+
+
+# the finance report is tab separated, and has a second table at the end
+# that starts with a Total_Rows line
+def generateAppleFinance(rows, products, date=date, path=None):
+    names = productNames(products)
+    path = path or 'tmp/' + itunes.filename(date)
+
+    with open(path, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(apple_columns)
+        for row in range(rows):
+            quantity = random.choice([1, 1, 1, 2, 5, -1])
+            currency = random.choice(currencies)
+            writer.writerow([
+                f'{date.month}/01/{date.year}', f'{date.month}/28/{date.year}', '', '', 'vendor',
+                quantity, '0.70', f'{quantity * 0.7:.2f}', currency, '0.99', currency, 'US',
+                '123456789', 'Developer', random.choice(names), '', '', 'IA1', '', '', ''])
+        writer.writerow(['Total_Rows', rows])
+        writer.writerow(['Country Of Sale', 'Partner Share Currency', 'Quantity', 'Extended Partner Share'])
+        writer.writerow(['US', 'USD', rows, '0.00'])
+
+    return [path]
+
+
+# the proceeds report is downloaded by hand, it starts with two lines of
+# junk and ends with the payout in a footer
+def generateAppleProceeds(date=date):
+    path = os.path.join('proceeds', f'{date.year}-{date.month}.csv')
+
+    with open(path, 'w', encoding='utf8', newline='') as f:
+        f.write(f'"iTunes Connect - Payments and Financial Reports\t({month_names[int(date.month) - 1]}, {date.year})"\n\n')
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow([
+            'Territory (Currency)', 'Units Sold', 'Earned', 'Pre-Tax Subtotal', 'Input Tax',
+            'Adjustments', 'Withholding Tax', 'Total Owed', 'Exchange Rate', 'Proceeds',
+            'Bank Account Currency'])
+        for currency in currencies:
+            writer.writerow([
+                f'Somewhere ({currency})', random.randint(100, 900), f'{random.uniform(100, 900):.2f}',
+                '0', '0', '0', '0', '0', '1', f'{random.uniform(1000, 9000):.2f}', 'SEK'])
+        writer.writerow([''] * 11)
+        writer.writerow([''] * 10 + [f'{random.uniform(10000, 90000):,.2f} SEK'])
+
+    return [path]
+
+
+# (key, amount) pairs for the accumulator on its own, with as many keys as asked
+# for, a report only has a few hundred, but a rollup of a big catalogue can
+# have tens of thousands
+def accumulatorRows(rows, keys):
+    types = sorted(set(google_types))
+    names = [(f'Product {index:06d}', types[index % len(types)]) for index in range(keys)]
+    return [(random.choice(names), f'{random.uniform(-2, 40):.2f}') for _ in range(rows)]
+
+
+# fills an accumulator the way the parsers do, freezes it, adds it up the way
+# months are put together and rolled up, and turns it into what a report is
+# made from
+def accumulate(rows):
+    accumulator = Accumulator()
+    slots = accumulator.slots
+    counts = accumulator.counts
+    sums = accumulator.sums
+    for key, amount in rows:
+        slot = slots.get(key)
+        if slot is None:
+            slot = accumulator.slot(key)
+        counts[slot] += 1
+        sums[slot] += Decimal(amount)
+    accumulator.freeze()
+
+    total = Accumulator().freeze()
+    total.add(accumulator)
+    total.add(accumulator)
+    return list(total.collections())
+
+
+# the same as accumulate, with an object per key like before the accumulator,
+# so the two can be compared on the same rows
+def collect(rows):
+    collections = dict()
+    for key, amount in rows:
+        collection = collections.get(key)
+        if collection is None:
+            collection = collections[key] = TransactionCollection()
+        collection.count += 1
+        collection.sum += Decimal(amount)
+
+    total = dict()
+    for _ in range(2):
+        for key, collection in collections.items():
+            if key not in total:
+                total[key] = TransactionCollection()
+            total[key].add(collection)
+    return list(total.items())
+
+
+# runs a benchmark twice, once for time and once for memory, tracing the
+# allocations slows things down too much to time them at the same time
+def measure(function, rows, paths, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    seconds = min(timings)
+    return {
+        'rows': rows,
+        'bytes': sum(os.path.getsize(path) for path in paths),
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds > 0 else None,
+        'peak_memory': peak,
+    }
+
+
+# the ways the stores can read a month, as options for their config sections.
+# options a store doesn't have are left alone by it
+engines = {
+    'csv': {},
+    'pandas': {'engine': 'pandas'},
+    'arrow': {'engine': 'arrow'},
+    'ledger': {'ledger': 'true'},
+    'chunked': {'chunk_threshold_mb': '0', 'chunk_workers': '2'},
+    'zip': {'extract': 'false'},
+}
+
+
+# a month only the parity check reads, its product titles have line breaks in
+# them, and there are enough rows that the readers that go through a file a
+# block at a time (arrow, the chunks) have to split it inside quoted fields
+parity_date = TaxMonth('2022', '06')
+parity_rows = 60000
+
+
+# renders the generated month of every store with every engine, and compares
+# the reports to what the csv engine makes of it. the cache is cleared before
+# each one, or they'd all get the first one's numbers. returns the (store,
+# engine) pairs that came out different
+def parity(appleConfig, packagemap):
+    generateGoogle(parity_rows, 50, 1, date=parity_date, multiline=True)
+    generatePlayPass(parity_rows, 50, date=parity_date, multiline=True)
+
+    stores = {
+        'googleplay': lambda config: googleplay.parseMonth(config, date),
+        'googleplay multiline': lambda config: googleplay.parseMonth(config, parity_date),
+        'googleplaypass': lambda config: googleplaypass.parseMonth(config, date, packagemap),
+        'googleplaypass multiline': lambda config: googleplaypass.parseMonth(config, parity_date, packagemap),
+        'itunes': lambda config: itunes.parseMonth(dict(appleConfig, **config), date),
+    }
+
+    mismatches = []
+    for store, parse in stores.items():
+        reports = dict()
+        for engine, options in engines.items():
+            shutil.rmtree(cache.cache_path, ignore_errors=True)
+            try:
+                reports[engine] = parse(options).render()
+            except Exception as e:
+                print(f'\t⚠️ {store} with the {engine} engine failed: {e}')
+                reports[engine] = None
+            if reports[engine] != reports['csv']:
+                mismatches.append((store, engine))
+    return mismatches
+
+
+def runParsers(args):
+    random.seed(args.seed)
+    os.makedirs('tmp')
+    os.makedirs('proceeds')
+
+    print(f'Generating {args.rows} rows per report for {args.products} products...')
+    googlePaths = generateGoogle(args.rows, args.products, args.files)
+    playpassPaths = generatePlayPass(args.rows, args.products)
+    applePaths = generateAppleFinance(args.rows, args.products)
+    applePaths += generateAppleProceeds()
+
+    keyRows = accumulatorRows(args.rows, args.keys)
+
+    appleConfig = {'proceeds_report_path': 'proceeds'}
+    packagemap = dict()
+
+    print('Checking that every engine renders the same reports...')
+    mismatches = parity(appleConfig, packagemap)
+    for store, engine in mismatches:
+        print(f'\t⚠️ {store} with the {engine} engine does not match the csv engine')
+    if len(mismatches) > 0:
+        sys.exit(1)
+
+    # reports for merge, it needs a store month and the month before it for play pass
+    store = {date.key(): googleplay.parseSingle(googleplay.readRows(googlePaths), date)}
+    playpass = {googleplaypass.adjustTaxMonth(date, -1).key():
+                googleplaypass.parseSingle(googleplay.readRows(playpassPaths), date, packagemap)}
+
+    benchmarks = {
+        'googleplay.parseSingle': (
+            lambda: googleplay.parseSingle(googleplay.readRows(googlePaths), date),
+            args.rows, googlePaths),
+        'googleplaypass.parseSingle': (
+            lambda: googleplaypass.parseSingle(googleplay.readRows(playpassPaths), date, packagemap),
+            args.rows, playpassPaths),
+        'itunes.parseSingle': (
+            lambda: itunes.parseSingle(appleConfig, date),
+            args.rows, applePaths),
+        'utils.TransactionCollection': (
+            lambda: collect(keyRows),
+            args.rows, []),
+        'utils.Accumulator': (
+            lambda: accumulate(keyRows),
+            args.rows, []),
+        'googleplaypass.merge': (
+            lambda: [report.render() for month, report in googleplaypass.merge(store.items(), playpass.items())],
+            1, []),
+    }
+
+    results = dict()
+    for name, (function, rows, paths) in benchmarks.items():
+        print(f'\t{name}...')
+        results[name] = measure(function, rows, paths, args.repeat)
+
+    return results
+
+
+# modules whose import time we keep track of, taxman is what every run starts with
+import_modules = ['taxman', 'backends', 'itunes', 'googleplay', 'googleplaypass', 'pandas']
+
+import_code = '''
+import sys, time, tracemalloc
+sys.path.insert(0, {home!r})
+if {memory}:
+    tracemalloc.start()
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, tracemalloc.get_traced_memory()[1])
+'''
+
+
+# imports each module in a fresh interpreter, so nothing is imported already
+def runImports(args):
+    home = os.path.dirname(os.path.abspath(__file__))
+    results = dict()
+
+    for module in import_modules:
+        print(f'\timport {module}...')
+        timings = []
+        for _ in range(args.repeat + 1):
+            code = import_code.format(home=home, module=module, memory=False)
+            timings.append(float(subprocess.check_output([sys.executable, '-c', code], text=True).split()[0]))
+
+        code = import_code.format(home=home, module=module, memory=True)
+        peak = int(subprocess.check_output([sys.executable, '-c', code], text=True).split()[1])
+
+        # the first import compiles the module, so it is left out
+        results[f'import {module}'] = {
+            'rows': 0,
+            'bytes': 0,
+            'seconds': min(timings[1:]),
+            'rows_per_second': None,
+            'peak_memory': peak,
+        }
+
+    return results
+
+
+# the apple month a report is asked for with, see itunes.downloadSingle
+def appleMonth(date):
+    index = int(date.year) * 12 + int(date.month) - 1 + 3
+    return f'{index // 12}-{index % 12 + 1:02d}'
+
+
+def folderSize(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(path) for name in names)
+
+
+# the whole of taxman.py, downloads and all, against the offline stand-ins in
+# fakestores. each range of months is run cold (nothing downloaded or parsed
+# yet) and then warm (everything already there) for every --jobs
+def runPipeline(args):
+    import fakestores
+
+    random.seed(args.seed)
+    home = os.path.dirname(os.path.abspath(__file__))
+    vendor = 80000000
+    bucketId = '00000000000000000000'
+    months = [TaxMonth(str(2023 + index // 12), f'{index % 12 + 1:02d}') for index in range(max(args.months))]
+
+    os.makedirs('proceeds')
+    earningsPath = os.path.dirname(fakestores.bucketPath('bucket', bucketId, 'earnings', ''))
+    playpassPath = os.path.dirname(fakestores.bucketPath('bucket', bucketId, 'play_pass_earnings', ''))
+    os.makedirs(earningsPath)
+    os.makedirs(playpassPath)
+    os.makedirs(os.path.dirname(fakestores.reportPath('finance', vendor, '')))
+
+    print(f'Generating {len(months)} months of {args.rows} rows per report for {args.products} products...')
+    for month in months:
+        # only the zips go in the bucket
+        for path in generateGoogle(args.rows, args.products, args.files, month, earningsPath):
+            os.remove(path)
+        for path in generatePlayPass(args.rows, args.products, month, playpassPath):
+            os.remove(path)
+        generateAppleFinance(args.rows, args.products, month,
+                             fakestores.reportPath('finance', vendor, appleMonth(month)))
+        generateAppleProceeds(month)
+
+    server = fakestores.serveAppStore('finance', args.latency)
+    config = configparser.ConfigParser()
+    config['appstore'] = {
+        'key_id': 'BENCHMARK',
+        'key_file': fakestores.writeKey('key.p8'),
+        'issuer_id': '00000000-0000-0000-0000-000000000000',
+        'vendor_id': str(vendor),
+        'proceeds_report_path': 'proceeds',
+        'api_url': server.url,
+        'download_workers': str(args.download_workers),
+        'enabled': 'true',
+    }
+    config['google'] = {
+        'gcloud_path': fakestores.gcloudScript('.', 'bucket', args.latency),
+        'bucket_id': bucketId,
+        'download_workers': str(args.download_workers),
+        'enabled': 'true',
+        'play_pass_enabled': 'true',
+    }
+    config['output'] = {'path': 'out', 'verbose': 'false', 'overwrite': 'false'}
+    config['packages'] = {}
+    with open('taxman.cfg', 'w') as f:
+        config.write(f)
+
+    # what taxman prints goes here, it's a lot
+    log = open('taxman.log', 'w')
+
+    def taxman(count, jobs):
+        command = [sys.executable, os.path.join(home, 'taxman.py'),
+                   f'{months[0].year}{months[0].month}', f'{months[count - 1].year}{months[count - 1].month}',
+                   '--jobs', str(jobs)]
+        log.write(f'\n$ {" ".join(command)}\n')
+        log.flush()
+        start = time.perf_counter()
+        subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, check=True)
+        return time.perf_counter() - start
+
+    # taxman runs in processes of its own, so there is no peak memory to trace
+    def result(count, seconds):
+        rows = count * args.rows * 3
+        return {
+            'rows': rows,
+            'bytes': folderSize('tmp'),
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds > 0 else None,
+            'peak_memory': 0,
+        }
+
+    results = dict()
+    try:
+        for count in args.months:
+            for jobs in args.jobs:
+                for path in ['tmp', 'out']:
+                    if os.path.exists(path):
+                        shutil.rmtree(path)
+
+                print(f'\ttaxman {count} months --jobs {jobs}, cold...')
+                results[f'taxman {count}m jobs {jobs} cold'] = result(count, taxman(count, jobs))
+
+                print(f'\ttaxman {count} months --jobs {jobs}, warm...')
+                seconds = min(taxman(count, jobs) for _ in range(args.repeat))
+                results[f'taxman {count}m jobs {jobs} warm'] = result(count, seconds)
+    finally:
+        server.shutdown()
+        log.close()
+
+    return results
+
+
+def printResults(results):
+    print()
+    print('benchmark'.ljust(30) + 'rows'.rjust(12) + 'seconds'.rjust(12) + 'rows/s'.rjust(14) + 'µs/row'.rjust(10) + 'peak MB'.rjust(10))
+    for name, result in results.items():
+        rate = result['rows_per_second']
+        print(name.ljust(30)
+              + f'{result["rows"]:12d}'
+              + f'{result["seconds"]:12.4f}'
+              + (f'{rate:14,.0f}' if rate is not None else '-'.rjust(14))
+              + (f'{1000000 / rate:10.3f}' if rate is not None else '-'.rjust(10))
+              + f'{result["peak_memory"] / 1024 / 1024:10.1f}')
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(path, name, args, results):
+    data = {
+        'benchmark': name,
+        'commit': gitCommit(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'arguments': {key: value for key, value in vars(args).items() if key not in ['command', 'function']},
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+    print(f'\nResults saved to {path}')
+
+
+# compares two saved result files, a ratio above 1 means the new one is slower
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print(f'{old.get("commit")} -> {new.get("commit")}\n')
+    print('benchmark'.ljust(30) + 'old s'.rjust(12) + 'new s'.rjust(12) + 'ratio'.rjust(8) + 'mem ratio'.rjust(11))
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        ratio = result['seconds'] / before['seconds'] if before['seconds'] > 0 else float('nan')
+        memory = result['peak_memory'] / before['peak_memory'] if before['peak_memory'] > 0 else float('nan')
+        flag = '  ⚠️' if ratio > 1 + args.tolerance else ''
+        print(name.ljust(30) + f'{before["seconds"]:12.4f}{result["seconds"]:12.4f}{ratio:8.2f}{memory:11.2f}{flag}')
+
+
+# runs a benchmark in a scratch folder, which is removed afterwards
+def run(args):
+    workPath = tempfile.mkdtemp(prefix='taxman-bench-')
+    home = os.getcwd()
+    out = os.path.abspath(args.out) if args.out else None
+    os.chdir(workPath)
+    try:
+        results = args.function(args)
+    finally:
+        os.chdir(home)
+        if args.keep:
+            print(f'Benchmark files kept in {workPath}')
+        else:
+            shutil.rmtree(workPath)
+
+    printResults(results)
+    if out:
+        save(out, args.command, args, results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the report parsers.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parsers = commands.add_parser('parsers', help='Time the report parsers on generated data')
+    parsers.add_argument('--rows', type=int, default=100000, help='Rows per generated report')
+    parsers.add_argument('--products', type=int, default=50, help='Number of distinct products')
+    parsers.add_argument('--files', type=int, default=2, help='Number of zips the Google Play month is split over')
+    parsers.add_argument('--keys', type=int, default=50000, help='Number of distinct keys for the accumulator on its own')
+    parsers.add_argument('--repeat', type=int, default=3, help='Run each benchmark this many times, the fastest counts')
+    parsers.add_argument('--seed', type=int, default=1, help='Seed for the generated data')
+    parsers.add_argument('--out', help='Save the results as json to this file')
+    parsers.add_argument('--keep', action='store_true', help='Keep the generated files')
+    parsers.set_defaults(function=runParsers)
+
+    imports = commands.add_parser('imports', help='Time how long the modules take to import')
+    imports.add_argument('--repeat', type=int, default=5, help='Import each module this many times, the fastest counts')
+    imports.add_argument('--out', help='Save the results as json to this file')
+    imports.add_argument('--keep', action='store_true', help=argparse.SUPPRESS)
+    imports.set_defaults(function=runImports)
+
+    pipeline = commands.add_parser('pipeline', help='Time whole taxman runs against offline stand-ins for the stores')
+    pipeline.add_argument('--months', type=int, nargs='+', default=[3, 12], help='The ranges to run, in months')
+    pipeline.add_argument('--jobs', type=int, nargs='+', default=[1, 4], help='The --jobs to run every range with')
+    pipeline.add_argument('--rows', type=int, default=10000, help='Rows per generated report')
+    pipeline.add_argument('--products', type=int, default=50, help='Number of distinct products')
+    pipeline.add_argument('--files', type=int, default=2, help='Number of zips every Google Play month is split over')
+    pipeline.add_argument('--latency', type=float, default=0.2,
+                          help='Seconds the stand-ins wait before every answer, like the network would')
+    pipeline.add_argument('--download-workers', type=int, default=4, help='download_workers for both stores')
+    pipeline.add_argument('--repeat', type=int, default=3, help='Run the warm runs this many times, the fastest counts')
+    pipeline.add_argument('--seed', type=int, default=1, help='Seed for the generated data')
+    pipeline.add_argument('--out', help='Save the results as json to this file')
+    pipeline.add_argument('--keep', action='store_true', help='Keep the generated files')
+    pipeline.set_defaults(function=runPipeline)
+
+    comparer = commands.add_parser('compare', help='Compare two saved results')
+    comparer.add_argument('old')
+    comparer.add_argument('new')
+    comparer.add_argument('--tolerance', type=float, default=0.1, help='Flag benchmarks this much slower')
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        compare(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
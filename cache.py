@@ -0,0 +1,62 @@
+import gzip
+import hashlib
+import os
+import os.path
+import pickle
+import instrument
+import tmpcache
+
+# parsed months are kept here, one file per store and month
+cache_path = os.path.join('tmp', 'cache')
+
+
+# a fingerprint of the files a month was parsed from, if any of them change
+# (or the parser does) the fingerprint changes and the month is parsed again.
+# a compressed file counts as the file it was, see tmpcache.original
+def fingerprint(paths, version):
+    h = hashlib.sha1(f'{version}\n'.encode())
+    for path in paths:
+        if os.path.exists(path):
+            name, size, mtime = tmpcache.original(path)
+            h.update(f'{name}\t{size}\t{mtime}\n'.encode())
+        else:
+            h.update(f'{path}\tmissing\n'.encode())
+    return h.hexdigest()
+
+
+# returns the aggregates for a month, parse is only called if there is no
+# cached entry, or the source files have changed since it was stored
+def load(store, date, paths, version, parse):
+    path = os.path.join(cache_path, store, f'{date.key()}.pickle.gz')
+    key = fingerprint(paths, version)
+
+    if os.path.exists(path):
+        with instrument.stage('cache', store, date.key()) as record:
+            try:
+                with gzip.open(path, 'rb') as f:
+                    entry = pickle.load(f)
+                record.bytes_read += os.path.getsize(path)
+                if entry['fingerprint'] == key:
+                    tmpcache.touch(path)
+                    return entry['aggregates']
+            except (OSError, EOFError, pickle.UnpicklingError, KeyError, AttributeError):
+                # a broken entry is no worse than a missing one
+                pass
+
+    with instrument.stage('parse', store, date.key()) as record:
+        aggregates = parse()
+        if instrument.enabled:
+            record.bytes_read += sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+    # several stores may be parsed at once, any of them may make it first
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # write to a temporary file first, so a half written entry is never read
+    with instrument.stage('cache', store, date.key()) as record:
+        with gzip.open(path + '.part', 'wb') as f:
+            pickle.dump({'fingerprint': key, 'aggregates': aggregates}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.part', path)
+        if instrument.enabled:
+            record.bytes_written += os.path.getsize(path)
+
+    return aggregates
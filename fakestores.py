@@ -0,0 +1,236 @@
+import argparse
+import base64
+import glob
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import os.path
+import shutil
+import sys
+import threading
+import time
+import urllib.parse
+
+# stand-ins for the two places taxman downloads from, so the whole pipeline
+# can run (and be timed) on a machine without network or accounts
+#
+# gcloud: answers "storage objects list" and "storage cp" the way taxman calls
+#   them, from a folder laid out like the buckets, root/<bucket>/<path>/<zip>.
+#   point gcloud_path in [google] at the script gcloudScript() writes
+# appstore: answers the finance reports endpoint from root/<vendor>/<date>.txt
+#   where date is the (apple) reportDate asked for. point api_url in
+#   [appstore] at it, key_file still has to be a real EC key, see writeKey
+#
+# both can wait latency seconds before every answer, like the real thing does
+
+# the finance reports endpoint, as appstoreconnect.resources.FinanceReport has it
+finance_endpoint = '/v1/financeReports'
+
+
+# where a zip goes in the fake bucket, bucketId is the bucket_id option
+def bucketPath(root, bucketId, path, name):
+    return os.path.join(root, f'pubsite_prod_rev_{bucketId}', path, name)
+
+
+# where the finance report for a vendor and apple month goes
+def reportPath(root, vendor, reportDate):
+    return os.path.join(root, str(vendor), f'{reportDate}.txt')
+
+
+# the objects matching a gs:// url (wildcards and all), as (object name, path)
+def matching(root, url):
+    bucket, slash, name = url[len('gs://'):].partition('/')
+    bucketPath = os.path.join(root, bucket)
+    for path in sorted(glob.glob(os.path.join(bucketPath, name))):
+        if os.path.isfile(path):
+            yield os.path.relpath(path, bucketPath).replace(os.sep, '/'), path
+
+
+# what gcloud storage objects list --format=json says about a file, only the
+# fields taxman looks at
+def describe(name, path):
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.md5(f.read()).digest()
+    return {
+        'name': name,
+        'size': stat.st_size,
+        'generation': str(stat.st_mtime_ns),
+        'md5_hash': base64.b64encode(digest).decode('ascii'),
+    }
+
+
+# runs a gcloud command, returns the exit code. like the real one, a url that
+# matches nothing is an error
+def gcloud(root, latency, arguments):
+    time.sleep(latency)
+
+    if arguments[:3] == ['storage', 'objects', 'list']:
+        urls = [argument for argument in arguments[3:] if not argument.startswith('--')]
+        objects = [describe(name, path) for url in urls for name, path in matching(root, url)]
+        if len(objects) == 0:
+            print('ERROR: (gcloud.storage.objects.list) One or more URLs matched no objects.', file=sys.stderr)
+            return 1
+        print(json.dumps(objects, indent=2))
+        return 0
+
+    if arguments[:2] == ['storage', 'cp'] and len(arguments) >= 4:
+        urls, destination = arguments[2:-1], arguments[-1]
+        code = 0
+        for url in urls:
+            found = list(matching(root, url))
+            if len(found) == 0:
+                print(f'ERROR: (gcloud.storage.cp) The following URLs matched no objects or files:\n-{url}',
+                      file=sys.stderr)
+                code = 1
+            for name, path in found:
+                print(f'Copying {url} to file://{destination}', file=sys.stderr)
+                shutil.copy2(path, os.path.join(destination, os.path.basename(name)))
+        return code
+
+    print(f'ERROR: (gcloud) fakestores only knows storage objects list and storage cp, not {arguments}',
+          file=sys.stderr)
+    return 2
+
+
+# writes a script that runs the fake gcloud with this python, as gcloud_path
+# has to be something that can be run on its own. returns its path
+def gcloudScript(folder, root, latency=0):
+    script = os.path.abspath(__file__)
+    root = os.path.abspath(root)
+    if os.name == 'nt':
+        path = os.path.join(folder, 'gcloud.cmd')
+        with open(path, 'w') as f:
+            f.write(f'@"{sys.executable}" "{script}" gcloud --root "{root}" --latency {latency} %*\n')
+    else:
+        path = os.path.join(folder, 'gcloud')
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" gcloud --root "{root}" --latency {latency} "$@"\n')
+        os.chmod(path, 0o755)
+    return path
+
+
+# a private key apple would give us, the stub doesn't check the token but
+# the api library has to be able to sign one. needs cryptography
+def writeKey(path):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    with open(path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return path
+
+
+# the settings are on the server, see serveAppStore
+class AppStoreHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != finance_endpoint:
+            return self.error(404, 'NOT_FOUND', f'{url.path} is not a stubbed endpoint')
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self.error(401, 'NOT_AUTHORIZED', 'Missing bearer token')
+
+        # every rateLimit'th request is turned away, to exercise the retries
+        with self.server.lock:
+            self.server.requests += 1
+            limited = self.server.rateLimit > 0 and self.server.requests % self.server.rateLimit == 0
+        if limited:
+            return self.error(429, 'RATE_LIMIT_EXCEEDED', 'Too many requests', {'Retry-After': '0'})
+
+        filters = {key[len('filter['):-1]: values[0] for key, values in urllib.parse.parse_qs(url.query).items()
+                   if key.startswith('filter[')}
+        path = reportPath(self.server.root, filters.get('vendorNumber', ''), filters.get('reportDate', ''))
+        if not os.path.isfile(path):
+            return self.error(404, 'NOT_FOUND', 'There were no sales for the date specified.')
+
+        with open(path, 'rb') as f:
+            data = gzip.compress(f.read())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/a-gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # the same shape of error apple sends
+    def error(self, status, code, detail, headers=None):
+        data = json.dumps({'errors': [{'status': str(status), 'code': code, 'title': code, 'detail': detail}]})
+        data = data.encode('utf8')
+        self.send_response(status)
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+# starts the app store stub in a thread of its own, port 0 picks a free one.
+# returns the server, its url is in server.url and server.shutdown() stops it
+def serveAppStore(root, latency=0, rateLimit=0, port=0, verbose=False):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), AppStoreHandler)
+    server.daemon_threads = True
+    server.root = root
+    server.latency = latency
+    server.rateLimit = rateLimit
+    server.verbose = verbose
+    server.requests = 0
+    server.lock = threading.Lock()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline stand-ins for gcloud and App Store Connect.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fake = commands.add_parser('gcloud', help='Act as gcloud, this is what the script from gcloudScript runs')
+    fake.add_argument('--root', required=True, help='The folder with the buckets in it')
+    fake.add_argument('--latency', type=float, default=0, help='Seconds to wait before answering')
+    fake.add_argument('arguments', nargs=argparse.REMAINDER, help='The gcloud command')
+
+    script = commands.add_parser('gcloud-script', help='Write a script to use as gcloud_path')
+    script.add_argument('folder', help='Where to put the script')
+    script.add_argument('--root', required=True, help='The folder with the buckets in it')
+    script.add_argument('--latency', type=float, default=0, help='Seconds to wait before answering')
+
+    appstore = commands.add_parser('appstore', help='Serve finance reports until interrupted')
+    appstore.add_argument('--root', required=True, help='The folder with a folder of reports per vendor')
+    appstore.add_argument('--port', type=int, default=8000)
+    appstore.add_argument('--latency', type=float, default=0, help='Seconds to wait before answering')
+    appstore.add_argument('--rate-limit', type=int, default=0,
+                          help='Answer every Nth request with 429 Too Many Requests')
+
+    key = commands.add_parser('key', help='Write a private key to use as key_file')
+    key.add_argument('path')
+
+    args = parser.parse_args()
+
+    if args.command == 'gcloud':
+        sys.exit(gcloud(args.root, args.latency, args.arguments))
+    elif args.command == 'gcloud-script':
+        print(gcloudScript(args.folder, args.root, args.latency))
+    elif args.command == 'appstore':
+        server = serveAppStore(args.root, args.latency, args.rate_limit, args.port, verbose=True)
+        print(f'Serving finance reports from {args.root} on {server.url}, press ctrl+c to stop')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == 'key':
+        print(writeKey(args.path))
+
+
+if __name__ == '__main__':
+    main()
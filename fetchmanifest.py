@@ -0,0 +1,24 @@
+import json
+import os
+import os.path
+
+# one manifest per store, listing what we have downloaded for it
+manifest_path = os.path.join('tmp', 'fetched')
+
+
+def load(name):
+    try:
+        with open(os.path.join(manifest_path, f'{name}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save(name, manifest):
+    # write to a temporary file first, so a half written manifest is never read
+    path = os.path.join(manifest_path, f'{name}.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + '.part', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.part', path)
@@ -1,108 +1,549 @@
 import csv
 import datetime
 from utils import TransactionCollection
-from utils import format_currency
-from utils import format_count
+from utils import Report
+from utils import ReportSection
+from utils import ReportLine
+from utils import Accumulator
+from utils import account
+from utils import downloadPath
+from utils import chunkThreshold
+from utils import storeName
+from utils import TaxMonth
+from utils import adjustTaxMonth
 from decimal import Decimal
 from collections import defaultdict
+from collections import deque
 import os
 import urllib.request
 import zipfile
 import subprocess
 import glob
-from io import StringIO
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import io
+import mmap
 import os.path
-import pandas
+import cache
+import instrument
+import fetchmanifest
+import json
+import ledger
+import arrowcsv
+import tmpcache
+
+# bump this whenever a change to aggregate() changes its results
+parser_version = 3
+
+# the bucket folders and the stores they hold reports for
+stores = {'earnings': 'google play store', 'play_pass_earnings': 'google play pass'}
 
 
 def get(config, dates):
     print(f'Google Play')
 
-    data = []
+    fetch(config, dates)
+    return parse(config, dates)
 
-    if not os.path.exists('tmp'):
-        os.makedirs('tmp')
 
+# yields the month and the report for that month, one at a time, so only
+# the month being looked at is held in memory
+def parse(config, dates):
     for date in dates:
-        filename = f'tmp/{date.year}{date.month}.csv'
+        monthReport = parseMonth(config, date)
+        if monthReport is not None:
+            yield date.key(), monthReport
+
+
+# ready is called with each month once its files are in place, so it can be
+# parsed while the other months are still downloading. a month also takes
+# transactions from the reports before and after it, see aggregateMonth, so
+# those are fetched too, and each month is only handed on once they're here.
+# that way a month comes out the same whatever range it was run with
+def fetch(config, dates, ready=None):
+    waiting = deque(dates)
+    arrived = set()
+
+    def handOver(month):
+        arrived.add(month)
+        while waiting and all(neighbour in arrived for neighbour in neighbours(waiting[0])):
+            date = waiting.popleft()
+            if ready is not None:
+                ready(date)
+
+    months = sorted({month for date in dates for month in neighbours(date)})
+    sync(config, months, 'earnings', handOver)
+    for date in waiting:
+        if ready is not None:
+            ready(date)
+
+
+# makes sure we have the latest zips for the months, this lists everything in
+# the bucket folder with a single call and only downloads the zips that are
+# new or have changed since we last fetched them, see fetchmanifest
+def sync(config, dates, path, ready=None):
+    # the store and play pass sync at the same time, into the same folder
+    os.makedirs(downloadPath(config), exist_ok=True)
+
+    remote = listRemote(config, path)
+
+    if remote is None:
+        # we couldn't list the bucket, so fetch the months we have nothing for
+        missing = {date: None for date in dates if len(sourcePaths(config, date, path)) == 0}
+        if len(missing) > 0:
+            print(f'\tFetching data for {len(missing)} months from Google...')
+        downloadAll(config, dates, path, missing, ready)
+        return
 
-        if not os.path.exists(filename):
-            print('\tFetching data from Google...')
-            download(config, date, 'earnings')
+    manifest = fetchmanifest.load(manifestName(config, path))
+    months = {f'{date.year}{date.month}': date for date in dates}
 
+    # the zips that need downloading, per month
+    changed = defaultdict(list)
+    # months where we have all zips, but they haven't been extracted
+    unextracted = set()
 
-        paths = glob.glob(os.path.join('tmp', f'earnings{date.year}{date.month}*.csv'))
-        
-        print(f'\tParsing data for {date.year}-{date.month} ({len(paths)} files)... ')
+    for remoteObject in remote:
+        name = os.path.basename(remoteObject['name'])
+        date = months.get(name[len(path) + 1:len(path) + 7])
+        if date is None:
+            continue
 
-        # combine all files in the list
-        combined_csv = pandas.concat([pandas.read_csv(f) for f in paths ])
-        # export to csv
-        combined_path = os.path.join('tmp', f'{date.year}{date.month}.csv')
-        combined_csv.to_csv(combined_path, index=False, encoding='utf-8')
+        localPath = os.path.join(downloadPath(config), name)
+        known = manifest.get(remoteObject['name'])
+        if known is None and os.path.exists(localPath) and os.path.getsize(localPath) == remoteObject['size']:
+            # downloaded before we kept a manifest, take it as it is
+            manifest[remoteObject['name']] = known = remoteObject
 
-        data.append(open(combined_path, encoding="utf8").read())
+        if known != remoteObject or not os.path.exists(localPath):
+            changed[date].append(remoteObject)
+        elif extracting(config) and len(extractedPaths(config, date, path)) == 0:
+            unextracted.add(date)
 
-    return parse(data, dates)
+    for date in unextracted - set(changed):
+        extract(config, date, path)
 
+    if len(changed) > 0:
+        count = sum(len(objects) for objects in changed.values())
+        print(f'\tFetching {count} new or changed files for {len(changed)} months from Google...')
+    urls = {date: [f'gs://{bucket(config)}/{remoteObject["name"]}' for remoteObject in objects]
+            for date, objects in changed.items()}
+    found = downloadAll(config, dates, path, urls, ready)
 
-def download(config, date, path):
-    print(f'Fetching data for {date.year}-{date.month}')
-    url = f'gs://pubsite_prod_rev_{config.get("bucket_id")}'
-    url += f'/{path}/{path}_{date.year}{date.month}*.zip'
-    print(f'"{config.get("gcloud_path")}" storage cp {url} tmp')
-    subprocess.call(f'"{config.get("gcloud_path")}" storage cp {url} tmp')
+    # only remember what actually made it
+    for date, objects in changed.items():
+        if found.get(date):
+            for remoteObject in objects:
+                manifest[remoteObject['name']] = remoteObject
+
+    fetchmanifest.save(manifestName(config, path), manifest)
 
-    print('\tExtracting data...')
+
+# every account has its own manifests, see utils.account
+def manifestName(config, path):
+    return os.path.join(account(config), path) if account(config) != '' else path
+
+
+def bucket(config):
+    return f'pubsite_prod_rev_{config.get("bucket_id")}'
+
+
+# lists all zips in a bucket folder, with what we need to tell if they changed
+# returns None if the listing failed
+def listRemote(config, path):
+    url = f'gs://{bucket(config)}/{path}/{path}_*.zip'
 
     try:
-        # a single month may have more than one zip, just to make our life harder
-        # we use a wildcard to match them all here
-        zippaths = glob.glob(
-            os.path.join('tmp', f'{path}_{date.year}{date.month}*.zip')
-        )
-    except IndexError:
+        with instrument.stage('list', storeName(config, stores[path])):
+            listing = subprocess.check_output(
+                [config.get('gcloud_path'), 'storage', 'objects', 'list', url, '--format=json'])
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'\t⚠️ Could not list {url}: {e}')
+        return None
+
+    remote = []
+    for remoteObject in json.loads(listing or '[]'):
+        remote.append({
+            'name': remoteObject['name'],
+            'size': int(remoteObject.get('size', 0)),
+            'generation': str(remoteObject.get('generation', '')),
+            'hash': remoteObject.get('md5_hash') or remoteObject.get('crc32c_hash'),
+        })
+    return remote
+
+
+# parses a single month from the downloaded files, returns None if there
+# is no data for the month. this only uses its arguments and the files, so
+# months can be parsed in separate processes
+def parseMonth(config, date):
+    aggregates = aggregateMonth(config, date)
+    if aggregates is None:
+        return None
+    monthReport = report(aggregates, date)
+    monthReport.provisional = provisional(config, date)
+    return monthReport
+
+
+# the aggregates for a month, these come from the cache (or the ledger) unless
+# the files have changed. returns None if there is no data for the month
+#
+# the report for a month sometimes has a few transactions from the months
+# next to it. those are bucketed on the month they're in when the report is
+# parsed, see aggregate, and a month is what's left in its own report plus
+# what the reports before and after it had for it
+def aggregateMonth(config, date):
+    paths = sourcePaths(config, date, 'earnings')
+
+    if len(paths) == 0:
+        print(f'\tNo data for {date.year}-{date.month}, skipping')
+        return None
+
+    print(f'\tParsing data for {date.year}-{date.month} ({len(paths)} files)... ')
+
+    store = storeName(config, 'google play store')
+    if config.get('ledger', 'false') == 'true':
+        # the ledger keeps the transactions under the month they're in, so
+        # they're picked out of the reports around it as well
+        paths = inputPaths(config, date)
+        return ledger.load(store, date, paths, parser_version,
+                           lambda: entries(readRows(paths), date, 'Product Title'),
+                           lambda connection: aggregateLedger(connection, store, date))
+
+    return compose(date, [bucketMonth(config, month, store) for month in neighbours(date)])
+
+
+# the reports for the months as they're fetched, see taxman.streams. run
+# parses tasks in the pool, see taxman.parseAll
+#
+# a task per month would parse every report up to three times, once for the
+# month and once for each month next to it, often at the same time in
+# different workers. so instead every report gets a task of its own, see
+# bucketReport, and the months are put together from the buckets here
+def parseStream(config, dates, run):
+    if config.get('ledger', 'false') == 'true':
+        # the ledger has its own way of keeping each report once
+        yield from run((date, parseMonth, (config, date)) for date in dates)
+        return
+
+    waiting = deque()
+    found = dict()
+
+    def tasks():
+        scheduled = set()
+        for date in dates:
+            waiting.append(date)
+            for month in sorted(neighbours(date)):
+                if month not in scheduled:
+                    scheduled.add(month)
+                    yield month, bucketReport, (config, month)
+
+    # the results come in the order the tasks went out, so once the report
+    # after a month is in, so are the ones it needs
+    def done(last=False):
+        while waiting and (last or adjustTaxMonth(waiting[0], +1).key() in found):
+            date = waiting.popleft()
+            if len(found[date.key()]) == 0:
+                print(f'\tNo data for {date.year}-{date.month}, skipping')
+            else:
+                aggregates = compose(date, [found.get(month.key()) for month in neighbours(date)])
+                monthReport = report(aggregates, date)
+                monthReport.provisional = len(found[adjustTaxMonth(date, +1).key()]) == 0
+                yield date.key(), monthReport
+            # the months after this one don't need the report before it
+            found.pop(adjustTaxMonth(date, -1).key(), None)
+
+    for key, buckets in run(tasks()):
+        found[key] = buckets
+        yield from done()
+    yield from done(last=True)
+
+
+# a month takes the rows for it from the report after it as well, so until
+# that report is out the month may still change. the report before it is
+# always out already, so a month without one just had nothing before it
+def provisional(config, date):
+    return len(sourcePaths(config, adjustTaxMonth(date, +1), 'earnings')) == 0
+
+
+# the month and the ones right before and after it, transactions are never
+# further off than that
+def neighbours(date):
+    return [date, adjustTaxMonth(date, -1), adjustTaxMonth(date, +1)]
+
+
+# a month's aggregates, from the buckets of the reports for it and the months
+# next to it, see bucketMonth. a report that isn't there is None
+def compose(date, reports):
+    aggregates = Accumulator().freeze()
+    for buckets in reports:
+        if buckets is not None and date.key() in buckets:
+            aggregates.add(buckets[date.key()])
+    return aggregates
+
+
+# a task for parseStream, the buckets of the report for a month, or nothing
+# if there is no report
+def bucketReport(config, date):
+    paths = sourcePaths(config, date, 'earnings')
+    if len(paths) == 0:
+        return dict()
+
+    print(f'\tParsing data for {date.year}-{date.month} ({len(paths)} files)... ')
+    return bucketMonth(config, date, storeName(config, 'google play store'))
+
+
+# the transactions in the report for a month, bucketed on the month they're
+# in, see aggregate. these are what's cached. None if there is no report
+def bucketMonth(config, date, store):
+    paths = sourcePaths(config, date, 'earnings')
+    if len(paths) == 0:
+        return None
+
+    # big months are split up and parsed on all cores, small months are
+    # faster to just parse directly
+    size = sum(os.path.getsize(path) for path in paths)
+    threshold = chunkThreshold(config)
+
+    engine = arrowcsv.engine(config)
+    if engine == 'pandas':
+        parse = lambda: aggregateFrame(paths, date)
+    elif engine == 'arrow':
+        # arrow already reads every file on all cores
+        parse = lambda: aggregateTable(paths, date)
+    elif size > threshold and all(path.endswith('.csv') for path in paths):
+        workers = int(config.get('chunk_workers', os.cpu_count()))
+        parse = lambda: aggregateChunked(paths, date, workers)
+    else:
+        parse = lambda: aggregate(readRows(paths), date)
+
+    return cache.load(store, date, paths, parser_version, parse)
+
+
+# the files a month is parsed from, see watch. that's the reports before and
+# after it too, see aggregateMonth
+def inputPaths(config, date):
+    return [path for month in neighbours(date) for path in sourcePaths(config, month, 'earnings')]
+
+
+# the files the reports for a month are read from, the extracted csv files or,
+# with extract turned off, the zips they're read from without extracting them
+def sourcePaths(config, date, path):
+    if not extracting(config):
+        return zipPaths(config, date, path)
+    return extractedPaths(config, date, path)
+
+
+# lists the extracted csv files for a month, there is one per downloaded zip
+# they're gzipped once the month is closed, see tmpcache
+def extractedPaths(config, date, path):
+    folder = downloadPath(config)
+    return sorted(glob.glob(os.path.join(folder, f'{path}{date.year}{date.month}-*.csv')) +
+                  glob.glob(os.path.join(folder, f'{path}{date.year}{date.month}-*.csv.gz')))
+
+
+def extracting(config):
+    return config.get('extract', 'true') != 'false'
+
+
+# opens the files one after the other, a zip gives every csv inside it, read
+# as it's unpacked. mode is 'r' for text or 'rb' for bytes
+def openSources(paths, mode='r'):
+    for path in paths:
+        if path.endswith('.zip'):
+            tmpcache.touch(path)
+            with zipfile.ZipFile(path, 'r') as zfile:
+                for filename in zfile.namelist():
+                    with zfile.open(filename) as member:
+                        if mode == 'rb':
+                            yield member
+                        else:
+                            with io.TextIOWrapper(member, encoding='utf8', newline='') as f:
+                                yield f
+        else:
+            with tmpcache.openFile(path, mode) as f:
+                yield f
+
+
+# reads the rows of all files in sequence, without loading the files into memory
+# all files for a month share the same header, so this reads as one long csv
+def readRows(paths):
+    for f in openSources(paths):
+        yield from instrument.count(csv.DictReader(f))
+
+
+# downloads and extracts several months at the same time, each month gets its
+# own gcloud process, the number of concurrent processes is capped by the
+# download_workers setting. a month that fails is reported, but does not stop
+# the others. urls maps the months to download to the exact files to fetch for
+# them, or to None to fetch every zip for the month
+# ready is called with every month in dates, in order, as soon as it's done
+# (or didn't need downloading), whether it worked or not
+# returns a dictionary of month -> True if any data was found
+def downloadAll(config, dates, path, urls, ready=None):
+    workers = int(config.get('download_workers', 4))
+    found = dict()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # everything is started before we wait on anything, ready may block
+        # until the month before has been parsed
+        futures = {date: pool.submit(download, config, date, path, urls[date]) for date in dates if date in urls}
+        for date in dates:
+            future = futures.get(date)
+            if future is not None:
+                try:
+                    found[date] = future.result()
+                except Exception as e:
+                    print(f'\t⚠️ Fetching {path} for {date.year}-{date.month} failed: {e}')
+                    found[date] = False
+                else:
+                    status = 'done' if found[date] else 'no data'
+                    print(f'\tFetched {path} for {date.year}-{date.month}: {status}')
+            if ready is not None:
+                ready(date)
+
+    return found
+
+
+# without urls, this fetches every zip for the month using a wildcard
+def download(config, date, path, urls=None):
+    print(f'Fetching data for {date.year}-{date.month}')
+    if urls is None:
+        urls = [f'gs://{bucket(config)}/{path}/{path}_{date.year}{date.month}*.zip']
+    print(f'"{config.get("gcloud_path")}" storage cp {" ".join(urls)} tmp')
+    with instrument.stage('download', storeName(config, stores[path]), date.key()) as record:
+        # the arguments are passed as a list so the wildcard goes to gcloud as is
+        if subprocess.call([config.get('gcloud_path'), 'storage', 'cp'] + urls + [downloadPath(config)]) != 0:
+            return False
+        if instrument.enabled:
+            record.bytes_written += sum(os.path.getsize(zippath) for zippath in zipPaths(config, date, path))
+
+    if not extracting(config):
+        return len(zipPaths(config, date, path)) > 0
+    return extract(config, date, path)
+
+
+# a single month may have more than one zip, just to make our life harder
+# we use a wildcard to match them all here
+def zipPaths(config, date, path):
+    return sorted(glob.glob(os.path.join(downloadPath(config), f'{path}_{date.year}{date.month}*.zip')))
+
+
+def extract(config, date, path):
+    zippaths = zipPaths(config, date, path)
+
+    if len(zippaths) == 0:
         print(f'\t⚠️ No data found for {date.year}{date.month}')
         return False
-    else:
-        # iterate over all files in the zip, extracting them one by one
-        # i have never seen a report have more than one file in its zip,
-        # but this gives us access to the file name of the file we're extracting
-        # we need this so we can rename it immediately after extracting
-        
-        # this is needed because when a report comes in multiple zips, the contained csv's
-        # will have the SAME name, meaning they'll overwrite eachother!
 
+    print(f'\tExtracting data for {date.year}-{date.month}...')
+
+    # a new zip can shift the index of the others, so start from scratch
+    for oldname in extractedPaths(config, date, path):
+        os.remove(oldname)
+
+    # iterate over all files in the zip, extracting them one by one
+    # i have never seen a report have more than one file in its zip,
+    # but this gives us access to the file name of the file we're extracting
+
+    # when a report comes in multiple zips, the contained csv's will have the
+    # SAME name, meaning they'd overwrite eachother! so each member is written
+    # straight to a name that includes the index of its zip. this also keeps
+    # months that are extracted at the same time from stepping on eachother
+    with instrument.stage('extract', storeName(config, stores[path]), date.key()) as record:
         for idx, zippath in enumerate(zippaths) :
             with zipfile.ZipFile(zippath, 'r') as zfile :
-                filenames = zfile.namelist()
-                for filename in filenames :
-                    zfile.extract(filename, 'tmp')
-                    oldname = os.path.join('tmp', filename)
-                    newname = os.path.join('tmp', f'{path}{date.year}{date.month}-{idx}.csv')
-                    # remove the new file if it exists, as to not cause errors
-                    if os.path.exists(newname) : os.remove(newname)
-                    os.rename(oldname, newname)
-        return True
+                for filename in zfile.namelist() :
+                    newname = os.path.join(downloadPath(config), f'{path}{date.year}{date.month}-{idx}.csv')
+                    with zfile.open(filename) as src, open(newname, 'wb') as dst :
+                        shutil.copyfileobj(src, dst)
+                    record.bytes_written += zfile.getinfo(filename).file_size
+            record.bytes_read += os.path.getsize(zippath)
+    return True
+
+
+# rows is an iterable of dictionaries, one per csv row, see readRows. this
+# only has the rows, so transactions from other months are left out
+def parseSingle(rows, date):
+    return report(aggregate(rows, date)[date.key()], date)
+
+
+# the month key of every transaction date we have seen, like 'Jan 5, 2023' ->
+# '2023-01'. strptime is slow and a month only has about 31 different dates,
+# so each one is only parsed once
+transaction_months = dict()
+
+
+def transactionMonth(text):
+    month = transaction_months.get(text)
+    if month is None:
+        timestamp = datetime.datetime.strptime(text, '%b %d, %Y')
+        month = TaxMonth(str(timestamp.year), str(timestamp.month).zfill(2)).key()
+        transaction_months[text] = month
+    return month
+
+
+# sums up the rows of the report for a month, bucketed on the month each
+# transaction is in. the result is what gets cached, a dictionary of month
+# key -> frozen Accumulator, with the month itself first and always there
+def aggregate(rows, date):
+    expected = date.key()
+
+    # the sum and count of every product and transaction type, the overall
+    # totals per transaction type are added up from these at the end
+    accumulator = Accumulator()
+    slots = accumulator.slots
+    counts = accumulator.counts
+    sums = accumulator.sums
+
+    # the same for the other months, there are hardly ever any
+    others = dict()
+    months = transaction_months
+
+    for row in rows:
+        text = row['Transaction Date']
+        month = months.get(text)
+        if month is None:
+            month = transactionMonth(text)
+        if month != expected:
+            if month not in others:
+                others[month] = Accumulator()
+            addRow(others[month], row)
+            continue
 
+        key = (row['Product Title'], row['Transaction Type'])
+        slot = slots.get(key)
+        if slot is None:
+            slot = accumulator.slot(key)
+        counts[slot] += 1
+        sums[slot] += Decimal(row['Amount (Merchant Currency)'])
 
-# takes a list of data, data is an array of csv strings per month
-# dates is a list of year/month tuples
-def parse(data, dates):
-    # output is a dictionary with the month as key
-    # and the generated report as value
-    output = dict()
+    buckets = {expected: accumulator.freeze()}
+    for month, other in others.items():
+        buckets[month] = other.freeze()
+    return keep(buckets, date)
 
-    for index, entry in enumerate(data):
-        key = dates[index].year + '-' + dates[index].month
-        output[key] = parseSingle(entry, dates[index])
 
-    return output
+# the slow way of adding a row to an accumulator, see aggregate
+def addRow(accumulator, row):
+    slot = accumulator.slot((row['Product Title'], row['Transaction Type']))
+    accumulator.counts[slot] += 1
+    accumulator.sums[slot] += Decimal(row['Amount (Merchant Currency)'])
 
 
-def parseSingle(entry, date):
-    input_file = csv.DictReader(StringIO(entry))
+# leaves out the buckets for months that aren't next to date, no month looks
+# for its transactions that far away, see aggregateMonth
+def keep(buckets, date):
+    near = {month.key() for month in neighbours(date)}
+    for month in list(buckets):
+        if month not in near:
+            print(f'⚠️ {sum(buckets[month].counts)} transactions in wrong month! expected: {date.year}-{date.month} got: {month}')
+            del buckets[month]
+    return buckets
 
+
+# turns an accumulator keyed on (product, transaction type) into the overall
+# and per product maps report() uses. both keep the order keys were first seen
+def totals(accumulator):
     # a TransactionCollection holds two values, a sum and a counts
     # we keep a dictionary of these hashed on the transaction type,
     # ie one for "Charge", one for "Google fee" and so on
@@ -110,67 +551,267 @@ def parseSingle(entry, date):
 
     # we keep a second dictionary that stores this same data, but per product
     # this is stored "one level down" ie product->transaction type->sum/count
-    products = dict(defaultdict(TransactionCollection))
-
-    for row in input_file:
-        timestamp = datetime.datetime.strptime(row['Transaction Date'], '%b %d, %Y').date()
-        # the date tuple here has the month as a string with a leading zero, the timestamp does not, hence the int-cast
-        if int(timestamp.month) != int(date.month) and timestamp.year != date.year :
-            print(f'⚠️ transaction in wrong month! expected: {date.year}-{date.month} got: {timestamp.year}-{timestamp.month}')
-            continue
+    products = dict()
 
-        # the dictionary is a defaultdict, so we can write to any key and it
-        # will automatically populate that with default values if it's the
-        # first time
-        key = row['Transaction Type']
-        overall[key].sum += Decimal(row['Amount (Merchant Currency)'])
-        overall[key].count += 1
-
-        # this defaultdict trickery won't work here, so we need to check if a
-        # key exists, if not we create it
-        productKey = row['Product Title']
+    for (productKey, key), collection in accumulator.collections():
+        overall[key].add(collection)
         if productKey not in products:
             products[productKey] = defaultdict(TransactionCollection)
-        product = products[productKey]
-        product[key].sum += Decimal(row['Amount (Merchant Currency)'])
-        product[key].count += 1
+        products[productKey][key] = collection
+
+    return overall, products
+
+
+# does the same as aggregate(), but splits the files into chunks that are
+# summed up in separate processes, the partial results are then added up
+# again in file order, which keeps the keys in the order they were first seen
+def aggregateChunked(paths, date, workers):
+    # aim for a few chunks per worker, so a slow chunk doesn't hold up the rest
+    size = sum(os.path.getsize(path) for path in paths)
+    chunkSize = max(1024 * 1024, size // (workers * 4))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for path in paths:
+            with open(path, encoding='utf8', newline='') as f:
+                fieldnames = next(csv.reader(f), None)
+            if fieldnames is None: continue
+            for start, end in chunkRanges(path, chunkSize):
+                futures.append(pool.submit(aggregateChunk, path, start, end, fieldnames, date))
+
+        return mergeBuckets(future.result() for future in futures)
+
+
+# splits a csv file (minus its header) into byte ranges of about chunkSize
+# each range ends on a line break that is not inside a quoted field, so every
+# range holds complete rows. a quote inside a field is written as two quotes,
+# so an even number of quotes means we're outside a field
+def chunkRanges(path, chunkSize):
+    ranges = []
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = data.find(b'\n') + 1
+            while 0 < start < len(data):
+                end = start + chunkSize
+                if end >= len(data):
+                    ranges.append((start, len(data)))
+                    break
+
+                quotes = data[start:end].count(b'"')
+                while True:
+                    newline = data.find(b'\n', end)
+                    if newline == -1:
+                        end = len(data)
+                        break
+                    quotes += data[end:newline + 1].count(b'"')
+                    end = newline + 1
+                    if quotes % 2 == 0:
+                        break
+
+                ranges.append((start, end))
+                start = end
+
+    return ranges
+
+
+def aggregateChunk(path, start, end, fieldnames, date):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf8')
+    return aggregate(csv.DictReader(io.StringIO(text, newline=''), fieldnames=fieldnames), date)
+
+
+# adds up several aggregates, keys are added in the order they are met, so
+# merging chunks in file order keeps the first seen order
+def mergeAggregates(partials):
+    merged = Accumulator().freeze()
+    for partial in partials:
+        merged.add(partial)
+    return merged
+
+
+# the same for the bucketed aggregates of several chunks, see aggregate
+def mergeBuckets(partials):
+    merged = dict()
+    for partial in partials:
+        for month, accumulator in partial.items():
+            if month not in merged:
+                merged[month] = Accumulator().freeze()
+            merged[month].add(accumulator)
+    return merged
+
+
+# the columnar engine, this does the same as aggregate(), but lets pandas
+# parse the dates and amounts a whole column at a time and sums them up with
+# group by instead of going row by row
+def aggregateFrame(paths, date):
+    frame = readFrame(paths, ['Transaction Date', 'Transaction Type',
+                              'Product Title', 'Amount (Merchant Currency)'])
+    instrument.current().rows += len(frame)
+
+    # bucketed like aggregate() does, every date is only looked up once
+    dates = frame['Transaction Date']
+    months = dates.map({text: transactionMonth(text) for text in dates.unique()})
+
+    buckets = {date.key(): aggregateGroups(frame[months == date.key()], 'Product Title')}
+    for month in months.unique():
+        if month != date.key():
+            buckets[month] = aggregateGroups(frame[months == month], 'Product Title')
+    return keep(buckets, date)
+
+
+# reads the given columns of all files for a month into one frame, everything
+# is kept as strings so amounts can be parsed exactly, see minorUnits
+def readFrame(paths, columns):
+    import pandas
+
+    frames = [pandas.read_csv(f, usecols=columns, dtype=str, keep_default_na=False)
+              for f in openSources(paths)]
+    return pandas.concat(frames, ignore_index=True)
+
+
+# builds the same aggregates as aggregate() from a frame, groups are kept in
+# the order they first appear, like the slots are. the amounts are already
+# whole numbers, so they go straight into a frozen accumulator
+def aggregateGroups(frame, productColumn):
+    accumulator = Accumulator().freeze()
+
+    if len(frame) == 0:
+        return accumulator
+
+    amounts, exponent = minorUnits(frame['Amount (Merchant Currency)'])
+    frame = frame.assign(amount=amounts)
+    accumulator.exponent = -exponent
+
+    groups = frame.groupby([productColumn, 'Transaction Type'], sort=False)['amount'].agg(['sum', 'size'])
+    for key, amount, count in groups.itertuples():
+        slot = accumulator.slot(key)
+        accumulator.counts[slot] = int(count)
+        accumulator.sums[slot] = int(amount)
+
+    return accumulator
+
+
+# the arrow engine, this does the same as aggregate(), but pyarrow parses the
+# files on several threads and sums up the groups, see arrowcsv
+def aggregateTable(paths, date):
+    import pyarrow
+    import pyarrow.compute as pc
+
+    table = arrowcsv.readTable(openSources(paths, 'rb'), ['Transaction Date', 'Transaction Type',
+                                       'Product Title', 'Amount (Merchant Currency)'])
+
+    # bucketed like aggregate() does, every date is only looked up once
+    dates = pc.dictionary_encode(table['Transaction Date'].combine_chunks())
+    months = pyarrow.array([transactionMonth(text) for text in dates.dictionary.to_pylist()], pyarrow.string())
+    months = months.take(dates.indices)
+
+    buckets = {date.key(): aggregateTotals(table.filter(pc.equal(months, date.key())), 'Product Title')}
+    for month in pc.unique(months).to_pylist():
+        if month != date.key():
+            buckets[month] = aggregateTotals(table.filter(pc.equal(months, month)), 'Product Title')
+    return keep(buckets, date)
+
+
+# builds the same aggregates as aggregate() from an arrow table
+def aggregateTotals(table, productColumn):
+    accumulator = Accumulator()
+
+    for key, amount, count in arrowcsv.totals(table, [productColumn, 'Transaction Type'],
+                                              'Amount (Merchant Currency)'):
+        slot = accumulator.slot(key)
+        accumulator.counts[slot] = count
+        accumulator.sums[slot] = amount
+
+    return accumulator.freeze()
+
+
+# the rows as they go into the ledger, see ledger.Entry. with date set, only
+# the transactions in that month are kept, the rows come from the reports
+# around it too, see aggregateMonth. date is None for play pass, where rows
+# are never in the wrong month
+def entries(rows, date, productColumn):
+    expected = date.key() if date is not None else None
+    months = transaction_months
 
-    text = f'Sales report for Google Play Apps {date.year}-{date.month}\n\n'
+    for row in rows:
+        if expected is not None:
+            text = row['Transaction Date']
+            month = months.get(text)
+            if month is None:
+                month = transactionMonth(text)
+            if month != expected:
+                continue
 
-    text += 'CHARGES, FEES, TAXES, AND REFUNDS:\n\n'
-    text += summarize(overall)
+        yield ledger.Entry(row[productColumn], row['Transaction Type'], row.get('Buyer Country'),
+                           row['Merchant Currency'], 1, Decimal(row['Amount (Merchant Currency)']))
+
+
+# builds the same aggregates as aggregate() from the ledger
+def aggregateLedger(connection, store, date):
+    accumulator = Accumulator()
+
+    for productKey, key, count, amount, paid in ledger.totals(connection, store, date, ['product', 'type']):
+        slot = accumulator.slot((productKey, key))
+        accumulator.counts[slot] = count
+        accumulator.sums[slot] = amount
+
+    return accumulator.freeze()
+
+
+# turns a column of decimal strings into exact integers, all scaled by the
+# same power of ten (the most decimals in the column), so they can be summed
+# without ever going through floats. returns the integers and that exponent
+def minorUnits(column):
+    column = column.str.strip()
+    negative = column.str.startswith('-')
+    parts = column.str.lstrip('+-').str.partition('.')
+    exponent = int(parts[2].str.len().max())
+    whole = parts[0].replace('', '0').astype('int64')
+    fraction = parts[2].str.ljust(exponent, '0').replace('', '0').astype('int64')
+    units = whole * 10 ** exponent + fraction
+    return units.where(~negative, -units), exponent
+
+
+def report(aggregates, date):
+    overall, products = totals(aggregates)
 
     # output per product data
-    text += '\n\n'
-    text += 'PER PRODUCT (including charges, fees, taxes, and refunds):\n\n'
+    productLines = []
     for key, value in products.items():
         # tax line is like a product, but has an empty key, skip it
         if key == '': continue
-        text += summarizeProduct(key, value)
+        productLines.append(summarizeProduct(key, value))
+
+    return Report(
+        f'Sales report for Google Play Apps {date.key()}',
+        [ReportSection('CHARGES, FEES, TAXES, AND REFUNDS', summarize(overall)),
+         ReportSection('PER PRODUCT (including charges, fees, taxes, and refunds)', productLines)],
+        summarizePayout(overall))
 
-    text += '\n\n'
-    text += summarizePayout(overall)
 
-    return text
+# one report for several months, months is an iterable of their aggregates
+# and period is a rollups.Period, it goes where the date usually does
+def rollup(months, period):
+    return report(mergeAggregates(months), period)
 
 
 def summarizePayout(collection):
     sum = Decimal(0)
     for key, value in collection.items():
         sum += value.sum
-    return 'Payout'.ljust(25) + f'{format_currency(sum)}'
+    return sum
 
 
 def summarize(collection):
-    text = ''
-    sum = Decimal(0)
+    lines = []
     for key, value in collection.items():
-        text += f'{key.ljust(25)}{format_currency(value.sum)}'
+        count = None
         if key == 'Charge' or key == 'Charge refund':
-            text += format_count(value.count).rjust(15)
-        text += '\n'
-        sum += value.sum
-    return text
+            count = value.count
+        lines.append(ReportLine(key, value.sum, count))
+    return lines
 
 
 def summarizeProduct(name, collection):
@@ -184,7 +825,7 @@ def summarizeProduct(name, collection):
             count -= value.count
         sum += value.sum
 
-    return f'{name.ljust(25)}{format_currency(sum)}{format_count(count)}\n'
+    return ReportLine(name, sum, count)
 
 
 def setup():
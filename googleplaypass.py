@@ -1,121 +1,161 @@
-import csv
-from utils import TransactionCollection
-from utils import format_currency
+from utils import Report
+from utils import ReportSection
+from utils import ReportLine
+from utils import MergedReport
+from utils import Accumulator
+from utils import storeName
+from utils import adjustTaxMonth
 from decimal import Decimal
-from collections import defaultdict
-import os
-from io import StringIO
-import os.path
-from googleplay import download
-import re
+from googleplay import sync
+from googleplay import sourcePaths
+from googleplay import readRows
+from googleplay import openSources
+from googleplay import readFrame
+from googleplay import aggregateGroups
+from googleplay import aggregateTotals
+from googleplay import entries
+from googleplay import aggregateLedger
+from googleplay import mergeAggregates
+from googleplay import totals
 from utils import TaxMonth
+import cache
+import instrument
+import ledger
+import arrowcsv
 
-merge_spacer = '\n\n--------------------------------------------------------------\n\n'
+# bump this whenever a change to aggregate() changes its results
+parser_version = 2
 
 
 def get(config, dates, packagemap):
     print('Google Play Pass')
 
-    data = []
+    fetch(config, dates)
+    return parse(config, dates, packagemap)
 
-    if not os.path.exists('tmp'):
-        os.makedirs('tmp')
 
+# yields the month and the report for that month, see googleplay.parse
+def parse(config, dates, packagemap):
     for date in dates:
-        filename = f'tmp/play_pass_earnings{date.year}{date.month}-0.csv'
-        file_exists = os.path.exists(filename)
+        monthReport = parseMonth(config, date, packagemap)
+        if monthReport is not None:
+            yield date.key(), monthReport
 
-        if not file_exists:
-            print('\tFetching data from Google...')
-            file_exists = download(config, date, 'play_pass_earnings')
 
-        if not file_exists:
-            print(f'\tNo data for {date.year}-{date.month}, returning empty')
-            return dict()
+# see googleplay.fetch
+def fetch(config, dates, ready=None):
+    sync(config, dates, 'play_pass_earnings', ready)
 
-        print(f'\tParsing data for {date.year}-{date.month}... ', end='')
-        data.append(open(filename, encoding="utf8").read(),)
-        print('done!')
 
-    return parse(data, dates, packagemap)
+# parses a single month, returns None if there is no data for the month
+# see googleplay.parseMonth
+def parseMonth(config, date, packagemap):
+    aggregates = aggregateMonth(config, date)
+    if aggregates is None:
+        return None
+    return report(aggregates, date, packagemap)
 
 
-# takes a list of data, data is an array of csv strings per month
-# dates is a list of year/month tuples
-def parse(data, dates, packagemap):
-    # output is a dictionary with the month as key
-    # and the generated report as value
-    output = dict()
+# see googleplay.inputPaths
+def inputPaths(config, date):
+    return sourcePaths(config, date, 'play_pass_earnings')
 
-    for index, entry in enumerate(data):
-        key = dates[index].year + '-' + dates[index].month
-        output[key] = parseSingle(entry, dates[index], packagemap)
 
-    return output
+# see googleplay.aggregateMonth
+def aggregateMonth(config, date):
+    paths = sourcePaths(config, date, 'play_pass_earnings')
 
+    if len(paths) == 0:
+        print(f'\tNo data for {date.year}-{date.month}, skipping')
+        return None
 
-def parseSingle(entry, date, packagemap):
-    input_file = csv.DictReader(StringIO(entry))
+    print(f'\tParsing data for {date.year}-{date.month} ({len(paths)} files)... ')
 
-    # a TransactionCollection holds two values, a sum and a counts
-    # we keep a dictionary of these hashed on the transaction type,
-    # ie one for "Charge", one for "Google fee" and so on
-    overall = defaultdict(TransactionCollection)
+    engine = arrowcsv.engine(config)
+    if engine == 'pandas':
+        parse = lambda: aggregateFrame(paths)
+    elif engine == 'arrow':
+        parse = lambda: aggregateTable(paths)
+    else:
+        parse = lambda: aggregate(readRows(paths))
 
-    # we keep a second dictionary that stores this same data, but per product
-    # this is stored "one level down" ie product->transaction type->sum/count
-    products = dict(defaultdict(TransactionCollection))
+    store = storeName(config, 'google play pass')
+    if config.get('ledger', 'false') == 'true':
+        aggregates = ledger.load(store, date, paths, parser_version,
+                                 lambda: entries(readRows(paths), None, 'Product Id'),
+                                 lambda connection: aggregateLedger(connection, store, date))
+    else:
+        aggregates = cache.load(store, date, paths, parser_version, parse)
+    return aggregates
 
-    for row in input_file:
-        # the dictionary is a defaultdict, so we can write to any key and it
-        # will automatically populate that with default values if it's the
-        # first time
-        key = row['Transaction Type']
-        overall[key].sum += Decimal(row['Amount (Merchant Currency)'])
-        overall[key].count += 1
 
-        # this defaultdict trickery won't work here, so we need to check if a
-        # key exists, if not we create it
-        productKey = row['Product Id']
-        if productKey not in products:
-            products[productKey] = defaultdict(TransactionCollection)
-        product = products[productKey]
-        product[key].sum += Decimal(row['Amount (Merchant Currency)'])
-        product[key].count += 1
+# rows is an iterable of dictionaries, one per csv row, see googleplay.readRows
+def parseSingle(rows, date, packagemap):
+    return report(aggregate(rows), date, packagemap)
 
-    text = 'Revenue report for Google Play Pass '
-    text += f'{date.year}-{date.month}\n\n'
 
-    text += summarize(overall)
+# sums up the rows of a month, the result is what gets cached
+def aggregate(rows):
+    # see googleplay.aggregate
+    accumulator = Accumulator()
+    slots = accumulator.slots
+    counts = accumulator.counts
+    sums = accumulator.sums
+
+    for row in rows:
+        key = (row['Product Id'], row['Transaction Type'])
+        slot = slots.get(key)
+        if slot is None:
+            slot = accumulator.slot(key)
+        counts[slot] += 1
+        sums[slot] += Decimal(row['Amount (Merchant Currency)'])
+
+    return accumulator.freeze()
+
+
+# the columnar engine, see googleplay.aggregateFrame
+def aggregateFrame(paths):
+    frame = readFrame(paths, ['Transaction Type', 'Product Id', 'Amount (Merchant Currency)'])
+    instrument.current().rows += len(frame)
+    return aggregateGroups(frame, 'Product Id')
+
+
+# the arrow engine, see googleplay.aggregateTable
+def aggregateTable(paths):
+    table = arrowcsv.readTable(openSources(paths, 'rb'), ['Transaction Type', 'Product Id', 'Amount (Merchant Currency)'])
+    return aggregateTotals(table, 'Product Id')
+
+
+def report(aggregates, date, packagemap):
+    overall, products = totals(aggregates)
 
     # output per product data
-    text += '\n\n'
-    text += 'PER PRODUCT (including charges, fees, taxes, and refunds):\n\n'
+    productLines = []
     for key, value in products.items():
-        name = packagemap.get(key, fallback=key)
-        text += summarizeProduct(name, value)
+        name = packagemap.get(key, key)
+        productLines.append(summarizeProduct(name, value))
+
+    return Report(
+        f'Revenue report for Google Play Pass {date.key()}',
+        [ReportSection(None, summarize(overall)),
+         ReportSection('PER PRODUCT (including charges, fees, taxes, and refunds)', productLines)],
+        summarizePayout(overall))
 
-    text += '\n\n'
-    text += summarizePayout(overall)
 
-    return text
+# see googleplay.rollup
+def rollup(months, period, packagemap):
+    return report(mergeAggregates(months), period, packagemap)
 
 
 def summarizePayout(collection):
     sum = Decimal(0)
     for key, value in collection.items():
         sum += value.sum
-    return 'Payout'.ljust(25) + f'{format_currency(sum)}'
+    return sum
 
 
 def summarize(collection):
-    text = ''
-    sum = Decimal(0)
-    for key, value in collection.items():
-        text += f'{key.ljust(25)}{format_currency(value.sum)}'
-        text += '\n'
-        sum += value.sum
-    return text
+    return [ReportLine(key, value.sum) for key, value in collection.items()]
 
 
 def summarizeProduct(name, collection):
@@ -123,58 +163,32 @@ def summarizeProduct(name, collection):
     for key, value in collection.items():
         sum += value.sum
 
-    return f'{name.ljust(25)}{format_currency(sum)}\n'
-
-
-def adjustTaxMonth(date, month_delta):
-    year = int(date.year)
-    month = int(date.month) + month_delta
-
-    while month < 1:
-        year -= 1
-        month += 12
-
-    while month > 12:
-        year += 1
-        month -= 12
-
-    return TaxMonth(str(year), str(month).zfill(2))
+    return ReportLine(name, sum)
 
 
 def parseTaxMonth(str):
     return TaxMonth(str[0:4], str[5:7])
 
 
+# playstore and playpass are (month, report) pairs in month order, like get()
+# yields. the merged reports are yielded the same way
 def merge(playstore, playpass):
-    # output is a dictionary with the month as key
-    # and the generated report as value
-    output = dict()
-
-    for month, monthData in playstore.items():
-        pay_date = parseTaxMonth(month)
-        pay_date = adjustTaxMonth(pay_date, +1)
-
-        output[month] = 'Report for Google Play as paid on '
-        output[month] += f'{pay_date.year}-{pay_date.month}\n\n'
-
-        output[month] += monthData + merge_spacer
-
-    for month, monthData in playpass.items():
-        pass_date = parseTaxMonth(month)
-        pass_date = adjustTaxMonth(pass_date, +1)
-        if pass_date.key() not in output:
-            continue
-        output[pass_date.key()] += monthData
-
-    for month, monthData in output.items():
-        # parse any lines that say Payout
-        payouts = re.findall(r'Payout\W+([\d ,]+) ', monthData)
-        sum = Decimal(0)
-        for payout in payouts:
-            stripped = payout.replace(',', '.').replace(' ', '')
-            decimal = Decimal(stripped)
-            sum += decimal
-
-        output[month] += merge_spacer + 'Total Payout:'.ljust(25) + f'{format_currency(sum)}\n'
-
-    return output
+    playpass = iter(playpass)
+    # the play pass report we have read but not used yet
+    pending = next(playpass, None)
+
+    for month, storeReport in playstore:
+        pay_date = adjustTaxMonth(parseTaxMonth(month), +1)
+        # play pass revenue is paid out a month after the store sales, so
+        # this months store report goes with last months play pass report
+        pass_month = adjustTaxMonth(parseTaxMonth(month), -1).key()
+
+        # skip past play pass months no store month was paid with, this way
+        # we hold at most one play pass report at a time
+        while pending is not None and pending[0] < pass_month:
+            pending = next(playpass, None)
+
+        passReport = None
+        if pending is not None and pending[0] == pass_month:
+            passReport = pending[1]
+        yield month, MergedReport(pay_date, storeReport, passReport)
@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# turned on by taxman.py --profile, until then stage() and count() do nothing
+enabled = False
+
+# every finished stage ends up here
+records = []
+lock = threading.Lock()
+started = time.perf_counter()
+
+# the stages that are running in each thread, so count() knows where to count
+local = threading.local()
+
+
+# a single stage of the work, for a store and month if it has one
+class Record:
+    def __init__(self, stage, store=None, month=None):
+        self.stage = stage
+        self.store = store
+        self.month = month
+        self.start = 0.0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def asdict(self):
+        return dict(vars(self))
+
+
+# handed out while profiling is off, anything written to it is thrown away
+discarded = Record(None)
+
+
+@contextmanager
+def stage(name, store=None, month=None):
+    if not enabled:
+        yield discarded
+        return
+
+    record = Record(name, store, month)
+    if not hasattr(local, 'stack'):
+        local.stack = []
+    local.stack.append(record)
+
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.start = start - started
+        record.seconds = time.perf_counter() - start
+        local.stack.pop()
+        with lock:
+            records.append(record)
+
+
+def current():
+    stack = getattr(local, 'stack', None)
+    return stack[-1] if stack else discarded
+
+
+# counts the rows of an iterable towards the current stage as they go by
+# when profiling is off, the rows are returned as they are
+def count(rows):
+    if not enabled:
+        return rows
+    return counted(rows, current())
+
+
+def counted(rows, record):
+    for row in rows:
+        record.rows += 1
+        yield row
+
+
+# runs a function with profiling on and returns its result together with
+# the stages it recorded, this is how stages get back from worker processes
+def run(function, *arguments):
+    global enabled
+    enabled = True
+    del records[:]
+    result = function(*arguments)
+    return result, [record.asdict() for record in records]
+
+
+def extend(recorded):
+    with lock:
+        for values in recorded:
+            record = Record(values['stage'])
+            vars(record).update(values)
+            records.append(record)
+
+
+# prints the time and io spent per stage and store, totals across months
+def summarize():
+    totals = defaultdict(lambda: Record(None))
+    calls = defaultdict(int)
+
+    for record in records:
+        key = (record.stage, record.store or '')
+        total = totals[key]
+        total.seconds += record.seconds
+        total.rows += record.rows
+        total.bytes_read += record.bytes_read
+        total.bytes_written += record.bytes_written
+        calls[key] += 1
+
+    text = 'stage'.ljust(12) + 'store'.ljust(20) + 'calls'.rjust(6) + 'seconds'.rjust(10)
+    text += 'rows'.rjust(12) + 'read MB'.rjust(10) + 'written MB'.rjust(12) + '\n'
+
+    for (stageName, store), total in totals.items():
+        text += stageName.ljust(12) + store.ljust(20) + f'{calls[(stageName, store)]:6d}'
+        text += f'{total.seconds:10.3f}{total.rows:12d}'
+        text += f'{total.bytes_read / 1024 / 1024:10.2f}{total.bytes_written / 1024 / 1024:12.2f}\n'
+
+    text += f'\nwall time {time.perf_counter() - started:.3f} seconds'
+    return text
+
+
+# writes every stage, per store and month, as json
+def save(path):
+    with open(path, 'w') as f:
+        json.dump({
+            'seconds': time.perf_counter() - started,
+            'stages': [record.asdict() for record in records],
+        }, f, indent=2)
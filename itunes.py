@@ -1,14 +1,38 @@
 from appstoreconnect import Api
+from appstoreconnect.api import BASE_API
+from appstoreconnect.resources import FinanceReport
 from collections import defaultdict
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 import csv
 from utils import TransactionCollection
-from utils import format_currency
-from utils import format_count
+from utils import Report
+from utils import ReportSection
+from utils import ReportLine
+from utils import MissingInput
+from utils import Accumulator
+from utils import account
+from utils import downloadPath
+from utils import storeName
 import re
 import os.path
+import cache
+import instrument
+import ledger
+import arrowcsv
+import tmpcache
+import fetchmanifest
+import hashlib
+import gzip
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# bump this whenever a change to aggregate() changes its results
+parser_version = 2
 
 
 def get(config, dates):
@@ -17,99 +41,318 @@ def get(config, dates):
     return parse(config, dates)
 
 
+# see googleplay.fetch
+def fetch(config, dates, ready=None):
+    download(config, dates, ready)
+
+
 def filename(date):
     return f'itunes_{date.year}-{date.month}.csv'
 
 
-def download(config, dates):
-    api = Api(config['key_id'], config['key_file'], config['issuer_id'])
-
-    for date in dates:
-        # make the actual date and the apple date, we pick a day in the middle
-        # of the month to try and avoid any "rounding" issues
-        actualDate = datetime(int(date.year), int(date.month), 15)
-        # the apple date is offset by a quarter
-        appleDate = actualDate + relativedelta(months=3)
-
-        outpath = 'tmp/' + filename(date)
-        # skip this file if we have it already
-        if os.path.exists(outpath):
+# where the report for a month is downloaded to
+def downloadedPath(config, date):
+    return os.path.join(downloadPath(config), filename(date))
+
+
+# where the report for a month is now, it's gzipped once the month is closed
+def reportPath(config, date):
+    return tmpcache.find(downloadedPath(config, date))
+
+
+# apple has no way to list the reports, but a closed month never changes,
+# so we only fetch months we don't have, or that don't match what we fetched
+def isFetched(config, manifest, date):
+    path = reportPath(config, date)
+    if not os.path.exists(path):
+        return False
+    if path.endswith('.gz'):
+        # only closed months are compressed, and they don't change
+        return True
+    known = manifest.get(filename(date))
+    return known is None or known['size'] == os.path.getsize(path)
+
+
+# ready is called with every month in dates, in order, see googleplay.downloadAll
+def download(config, dates, ready=None):
+    manifest = fetchmanifest.load(manifestName(config))
+
+    # skip the months we have already
+    missing = [date for date in dates if not isFetched(config, manifest, date)]
+    if len(missing) == 0:
+        for date in dates:
+            if ready is not None:
+                ready(date)
+        return
+
+    # the api object holds the signed token, all workers share it so the
+    # token is only generated once (or when it expires)
+    print('Connecting to AppStore Connect API...')
+    # the api library reports usage stats to its authors, which isn't going
+    # to work when we're pointed at a local server without network
+    api = Api(config['key_id'], config['key_file'], config['issuer_id'], submit_stats='api_url' not in config)
+    os.makedirs(downloadPath(config), exist_ok=True)
+
+    # the requests are mostly waiting on apple, so run a few at the same time
+    workers = int(config.get('download_workers', 4))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {date: pool.submit(downloadSingle, api, config, date) for date in missing}
+        for date in dates:
+            future = futures.get(date)
+            if future is not None:
+                try:
+                    manifest[filename(date)] = future.result()
+                except Exception as e:
+                    print(f'\t⚠️ Fetching {date.year}-{date.month} failed: {e}')
+                else:
+                    print(f'\tFetched {date.year}-{date.month}')
+            if ready is not None:
+                ready(date)
+
+    fetchmanifest.save(manifestName(config), manifest)
+
+
+# every account has its own manifest, see utils.account
+def manifestName(config):
+    return os.path.join(account(config), 'itunes') if account(config) != '' else 'itunes'
+
+
+def downloadSingle(api, config, date):
+    # make the actual date and the apple date, we pick a day in the middle
+    # of the month to try and avoid any "rounding" issues
+    actualDate = datetime(int(date.year), int(date.month), 15)
+    # the apple date is offset by a quarter
+    appleDate = actualDate + relativedelta(months=3)
+
+    print(f'Fetching data for {date.year}-{date.month}', end='')
+    print(f' ({appleDate.year}-{appleDate.month:02d} in Apple Time)')
+
+    path = downloadedPath(config, date)
+    with instrument.stage('download', storeName(config, 'app store'), date.key()) as record:
+        fetchFinanceReport(api, config, {
+            'regionCode': 'ZZ',
+            'reportType': 'FINANCIAL',
+            'vendorNumber': config['vendor_id'],
+            'reportDate': f'{appleDate.year}-{appleDate.month:02d}'},
+            path)
+        if instrument.enabled:
+            record.bytes_written += os.path.getsize(path)
+
+    # what we got, for the fetch manifest
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return {
+        'reportDate': f'{appleDate.year}-{appleDate.month:02d}',
+        'size': os.path.getsize(path),
+        'hash': digest,
+    }
+
+
+# fetches a finance report and saves it unpacked to outpath. this does the
+# same request as Api.download_finance_reports, but lets us retry when we are
+# rate limited, and point it at another server (api_url) for testing
+def fetchFinanceReport(api, config, filters, outpath):
+    url = config.get('api_url', BASE_API).rstrip('/') + FinanceReport.endpoint
+    url += '?' + urllib.parse.urlencode({f'filter[{k}]': v for k, v in filters.items()})
+    retries = int(config.get('download_retries', 5))
+
+    for attempt in range(retries + 1):
+        request = urllib.request.Request(url, headers={'Authorization': f'Bearer {api.token}'})
+        try:
+            with urllib.request.urlopen(request, timeout=api.timeout) as response:
+                data = response.read()
+        except urllib.error.HTTPError as e:
+            if e.code != 429 or attempt == retries:
+                raise
+            # back off exponentially, unless apple tells us how long to wait
+            delay = 2 ** attempt
+            retryAfter = e.headers.get('Retry-After', '')
+            if retryAfter.isdigit():
+                delay = int(retryAfter)
+            print(f'\tRate limited, retrying in {delay}s...')
+            time.sleep(delay)
             continue
 
-        print(f'Fetching data for {date.year}-{date.month}', end='')
-        print(f' ({appleDate.year}-{appleDate.month:02d} in Apple Time)')
+        # the reports come gzipped
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
 
-        print('Connecting to AppStore Connect API...')
-        api.download_finance_reports(filters={
-            'vendorNumber': config['vendor_id'],
-            'reportDate': f'{appleDate.year}-{appleDate.month:02d}'},
-            save_to=outpath)
+        # write to a temporary file first, so an interrupted download
+        # isn't mistaken for a finished one on the next run
+        with open(outpath + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(outpath + '.part', outpath)
+        return
 
 
-# takes a list of data, data is an array of csv strings per month
 # dates is a list of year/month tuples
 def parse(config, dates):
-    # output is a dictionary with the month as key
-    # and the generated report as value
-    output = dict()
-
+    # yields the month and the report for that month, see googleplay.parse
     for date in dates:
-        print(f'\tParsing data for {date.year}-{date.month}... ', end='')
-        key = date.year + '-' + date.month
-        output[key] = parseSingle(config, date)
-        print('done!')
+        monthReport = parseMonth(config, date)
+        if monthReport is not None:
+            yield date.key(), monthReport
+
+
+# parses a single month, returns None if there is no data for the month
+# see googleplay.parseMonth
+def parseMonth(config, date):
+    aggregates = aggregateMonth(config, date)
+    if aggregates is None:
+        return None
+    return report(aggregates, date)
+
+
+# see googleplay.aggregateMonth
+def aggregateMonth(config, date):
+    if not os.path.exists(reportPath(config, date)):
+        print(f'\tNo data for {date.year}-{date.month}, skipping')
+        return None
 
-    return output
+    print(f'\tParsing data for {date.year}-{date.month}... ')
+    store = storeName(config, 'app store')
+    if config.get('ledger', 'false') == 'true':
+        # the rows go into the ledger and the report is summed up from there
+        aggregates = ledger.load(store, date, sourcePaths(config, date), parser_version,
+                                 lambda: entries(config, date),
+                                 lambda connection: aggregateLedger(connection, store, date))
+    else:
+        aggregates = cache.load(store, date, sourcePaths(config, date), parser_version,
+                                lambda: aggregate(config, date, arrowcsv.engine(config)))
+    return aggregates
+
+
+# see googleplay.inputPaths
+def inputPaths(config, date):
+    return sourcePaths(config, date)
+
+
+# the api report and the manually downloaded proceeds report
+def sourcePaths(config, date):
+    return [reportPath(config, date), proceedsPath(config, date)]
+
+
+def proceedsPath(config, date):
+    return config['proceeds_report_path'] + f'/{date.year}-{date.month}.csv'
 
 
 def parseSingle(config, date):
+    return report(aggregate(config, date, arrowcsv.engine(config)), date)
+
+
+# reads both reports for a month, the result is what gets cached
+def aggregate(config, date, engine='csv'):
+    # the sales, keyed on product title and currency (which can include many
+    # countries), see utils.Accumulator
+    sales = Accumulator()
+
+    # the data from the payouts csv, keyed on currency. this stores the earned
+    # amount in the local currency, the unit count and most importantly the
+    # actual payout amount
+    payouts = Accumulator()
+
+    actualPayout = Decimal()
+
+    rows = entries(config, date)
+    if engine == 'arrow':
+        # arrow sums up the sales, the proceeds report is small enough to
+        # read row by row
+        sales = aggregateTable(config, date)
+        rows = proceedsEntries(config, date)
+
+    for entry in rows:
+        if entry.type == 'Sale':
+            slot = sales.slots.get((entry.product, entry.currency))
+            if slot is None:
+                slot = sales.slot((entry.product, entry.currency))
+            sales.counts[slot] += entry.quantity
+            sales.sums[slot] += entry.amount
+
+        elif entry.type == 'Proceeds':
+            slot = payouts.slot(entry.currency)
+            payouts.counts[slot] += entry.quantity
+            payouts.sums[slot] += entry.amount
+            payouts.paid[slot] += entry.paid
+
+        else:
+            # sometimes there's two payouts in one report, add instead
+            # of replacing the current payouts
+            actualPayout += entry.amount
+
+    return {'sales': sales.freeze(), 'payouts': payouts.freeze(), 'actualPayout': actualPayout}
+
+
+# the sales in the api report, summed up by arrow, see arrowcsv
+def aggregateTable(config, date):
+    # the file has a second table, starting at the Total_Rows line
+    with tmpcache.openFile(reportPath(config, date), 'rb') as f:
+        table = arrowcsv.readTable([f], ['Title', 'Partner Share Currency', 'Quantity', 'Extended Partner Share'],
+                                   '\t', b'Total_Rows')
+
+    sales = Accumulator()
+    for key, amount, count in arrowcsv.totals(table, ['Title', 'Partner Share Currency'],
+                                              'Extended Partner Share', 'Quantity'):
+        slot = sales.slot(key)
+        sales.counts[slot] = count
+        sales.sums[slot] = amount
+
+    return sales.freeze()
+
+
+# builds the same aggregates as aggregate() from the ledger
+def aggregateLedger(connection, store, date):
+    sales = Accumulator()
+    payouts = Accumulator()
+
+    for titleKey, currencyKey, count, amount, paid in ledger.totals(
+            connection, store, date, ['product', 'currency'], 'Sale'):
+        slot = sales.slot((titleKey, currencyKey))
+        sales.counts[slot] = count
+        sales.sums[slot] = amount
+
+    for currencyKey, count, amount, paid in ledger.totals(connection, store, date, ['currency'], 'Proceeds'):
+        slot = payouts.slot(currencyKey)
+        payouts.counts[slot] = count
+        payouts.sums[slot] = amount
+        payouts.paid[slot] = paid
+
+    actualPayout = Decimal()
+    for count, amount, paid in ledger.totals(connection, store, date, [], 'Payout'):
+        actualPayout = amount
+
+    return {'sales': sales.freeze(), 'payouts': payouts.freeze(), 'actualPayout': actualPayout}
+
+
+# reads both reports for a month, as they go into the ledger, see ledger.Entry
+def entries(config, date):
+    yield from saleEntries(config, date)
+    yield from proceedsEntries(config, date)
+
+
+def saleEntries(config, date):
     # first, we parse the data we can get from the API
     # this contains sales (currency and count) per country and product
     # but is missing data of what exactly was paid
     # that file needs to be manually retrieved from app store connect
-
-    # this dictionary is keyed on product title
-    # each value is yet another dictionary, this time keyed per currency
-    # (which can include many countries)
-    # these then hold a TransactionCollection that stores count and sum
-    products = dict()
-
-    # we keep a second dictionary for data from the payouts csv
-    # this stores the earned amount in the local currency, the unit count and
-    # most importantly the actual payout amount
-    payouts = defaultdict(TransactionCollection)
-
-    # parse the data we got from the api
-    with open('tmp/' + filename(date), newline='') as f:
+    with tmpcache.openFile(reportPath(config, date)) as f:
         reader = csv.DictReader(f, delimiter='\t')
 
-        for row in reader:
+        for row in instrument.count(reader):
             # the files contain two tables, once we reach the second one, bail
             if row['Start Date'] == 'Total_Rows':
                 break
 
-            titleKey = row['Title']
-            if titleKey not in products:
-                products[titleKey] = dict()
-            title = products[titleKey]
-
-            countryKey = row['Partner Share Currency']
-            if countryKey not in title:
-                title[countryKey] = TransactionCollection()
-            country = title[countryKey]
+            yield ledger.Entry(row['Title'], 'Sale', row.get('Country Of Sale'), row['Partner Share Currency'],
+                               int(row['Quantity']), Decimal(row['Extended Partner Share']))
 
-            country.count += int(row['Quantity'])
-            country.sum += Decimal(row['Extended Partner Share'])
 
+def proceedsEntries(config, date):
     # parse the data that was manually downloaded
-    report = config['proceeds_report_path'] + f'/{date.year}-{date.month}.csv'
+    report = proceedsPath(config, date)
     if not os.path.exists(report):
-        print(f'no app store payout report found for {date.year}-{date.month}')
-        print(f'you need to download this manually!')
-        print(f'put in this folder: ' + config['proceeds_report_path'])
-        exit()
-
-    actualPayout = Decimal()
+        raise MissingInput(f'no app store payout report found for {date.year}-{date.month}\n'
+                           f'you need to download this manually!\n'
+                           f'put in this folder: ' + config['proceeds_report_path'])
 
     with open(report, newline='') as f:
         # this file helpfully starts with two lines of nonsense, skip those
@@ -135,50 +378,68 @@ def parseSingle(config, date):
                 if re.match(r'\d', lastField) is not None:
                     # strip out anything that isn't a number or a period
                     stripped = re.sub(r'[^\d\.]', '', lastField)
-                    # sometimes there's two payouts in one report, add instead
-                    # of replacing the current payouts
-                    actualPayout += Decimal(stripped)
+                    yield ledger.Entry(None, 'Payout', None, None, 0, Decimal(stripped))
                 continue
 
-            currencyKey = x.group(1)
-            payouts[currencyKey].sum += Decimal(row['Earned'])
-            payouts[currencyKey].count += Decimal(row['Units Sold'])
-            payouts[currencyKey].paid += Decimal(row['Proceeds'])
+            yield ledger.Entry(None, 'Proceeds', row[currencyField], x.group(1), int(Decimal(row['Units Sold'])),
+                               Decimal(row['Earned']), Decimal(row['Proceeds']))
 
-    # for each product, add a "_" currency that stores a summary of sales
-    # in the payout currency
-    for product, currencies in products.items():
-        currencies['_'] = TransactionCollection()
 
-    text = f'Sales report for AppStore Connect {date.year}-{date.month}\n\n'
-    text += 'PER PRODUCT (including charges, fees, taxes, and refunds):\n\n'
+def report(aggregates, date):
+    return reportProducts(settle(aggregates), aggregates['actualPayout'], date)
 
-    calculatedPayout = Decimal()
-    for product, currencies in products.items():
-        for currency, transactions in currencies.items():
 
-            # skip the summary in the currency iteration
-            if currency == '_':
-                continue
+# one report for several months, see googleplay.rollup. every month is paid
+# at its own exchange rates, so the months are added up after they have been
+# turned into the payout currency
+def rollup(months, period):
+    products = dict()
+    actualPayout = Decimal()
+
+    for aggregates in months:
+        for product, total in settle(aggregates).items():
+            if product not in products:
+                products[product] = TransactionCollection()
+            products[product].add(total)
+        actualPayout += aggregates['actualPayout']
+
+    return reportProducts(products, actualPayout, period)
+
+
+# works out what each product earned in the payout currency, returns a
+# dictionary of product -> TransactionCollection with the paid amount and count
+def settle(aggregates):
+    payouts = defaultdict(TransactionCollection, aggregates['payouts'].collections())
+
+    # a summary of the sales of each product in the payout currency
+    products = dict()
+
+    for (product, currency), transactions in aggregates['sales'].collections():
+        if product not in products:
+            products[product] = TransactionCollection()
+        summary = products[product]
+
+        # calculate this produts share out of the total in this currency
+        # it's possible to not have any sales for a currency, so we need
+        # to guard for a division by zero here
+        fraction = 0
+        if payouts[currency].sum > 0:
+            fraction = transactions.sum / payouts[currency].sum
 
-            # calculate this produts share out of the total in this currency
-            # it's possible to not have any sales for a currency, so we need
-            # to guard for a division by zero here
-            fraction = 0
-            if payouts[currency].sum > 0:
-                fraction = transactions.sum / payouts[currency].sum
+        sharePayoutCurrency = Decimal(fraction * payouts[currency].paid)
+        summary.paid += sharePayoutCurrency
+        summary.count += transactions.count
 
-            sharePayoutCurrency = Decimal(fraction * payouts[currency].paid)
-            currencies['_'].paid += sharePayoutCurrency
-            currencies['_'].count += transactions.count
+    return products
 
-        calculatedPayout += currencies['_'].paid
-        text += product.ljust(25)
-        text += format_currency(currencies['_'].paid)
-        text += format_count(currencies['_'].count) + '\n'
 
-    text += '\n\n'
-    text += 'Payout'.ljust(25) + format_currency(actualPayout)
-    # text += '\nPayout'.ljust(25) + format_currency(calculatedPayout)
+def reportProducts(products, actualPayout, date):
+    productLines = []
+    for product, summary in products.items():
+        productLines.append(ReportLine(product, summary.paid, summary.count))
 
-    return text
+    # the payout is the actual payout, the sum of the products should be close to it
+    return Report(
+        f'Sales report for AppStore Connect {date.key()}',
+        [ReportSection('PER PRODUCT (including charges, fees, taxes, and refunds)', productLines)],
+        actualPayout)
@@ -0,0 +1,190 @@
+import os
+import os.path
+import sqlite3
+from decimal import Decimal
+from typing import NamedTuple, Optional
+import cache
+import instrument
+
+# every row of every report we have parsed, for questions the reports don't
+# answer, like what a product earned in one country over a quarter
+ledger_path = os.path.join('tmp', 'ledger.sqlite')
+
+# amounts are stored as whole millionths, so they can be summed exactly
+scale = 6
+
+schema = '''
+create table if not exists ingested (
+    store text not null,
+    month text not null,
+    fingerprint text not null,
+    primary key (store, month)
+);
+create table if not exists products (id integer primary key, name text not null unique);
+create table if not exists types (id integer primary key, name text not null unique);
+create table if not exists currencies (id integer primary key, code text not null unique);
+create table if not exists transactions (
+    store text not null,
+    month text not null,
+    -- the order the rows came in, the reports list things in the order seen
+    seq integer not null,
+    product integer references products (id),
+    type integer not null references types (id),
+    country text,
+    currency integer references currencies (id),
+    quantity integer not null,
+    amount integer not null,
+    paid integer
+);
+create index if not exists transactions_month on transactions (store, month);
+create index if not exists transactions_product on transactions (product);
+create index if not exists transactions_type on transactions (type);
+create index if not exists transactions_currency on transactions (currency);
+create index if not exists transactions_country on transactions (country);
+create view if not exists entries as
+    select transactions.store, transactions.month, transactions.seq,
+           products.name as product, types.name as type, transactions.country,
+           currencies.code as currency, transactions.quantity,
+           transactions.amount, transactions.paid
+    from transactions
+    join types on types.id = transactions.type
+    left join products on products.id = transactions.product
+    left join currencies on currencies.id = transactions.currency;
+'''
+
+# the columns you can group and filter on
+columns = ['store', 'month', 'product', 'type', 'country', 'currency']
+
+
+# a single row in the ledger, the stores turn their report rows into these
+#   google play: one per transaction, with a quantity of one
+#   app store:   a 'Sale' per row in the api report, a 'Proceeds' per currency
+#                in the proceeds report, with what it paid, and a 'Payout'
+#                for each payout line at the end of it
+class Entry(NamedTuple):
+    product: Optional[str]
+    type: str
+    country: Optional[str]
+    currency: Optional[str]
+    quantity: int
+    amount: Decimal
+    paid: Optional[Decimal] = None
+
+
+def connect():
+    if not os.path.exists(os.path.dirname(ledger_path)):
+        os.makedirs(os.path.dirname(ledger_path))
+
+    # months may be ingested by several processes at the same time, wal lets
+    # them read while one of them writes, the timeout makes them take turns
+    connection = sqlite3.connect(ledger_path, timeout=60)
+    connection.execute('pragma journal_mode = wal')
+    connection.executescript(schema)
+    return connection
+
+
+def units(value):
+    if value is None:
+        return None
+    return int(Decimal(value).scaleb(scale).to_integral_value())
+
+
+def decimal(value):
+    return Decimal(value or 0).scaleb(-scale)
+
+
+# same as cache.load, but the rows go into the ledger and the aggregates are
+# summed up from there. entries returns the rows for the month and aggregate
+# builds the aggregates from a connection
+def load(store, date, paths, version, entries, aggregate):
+    connection = connect()
+    try:
+        ingest(connection, store, date, paths, version, entries)
+        with instrument.stage('ledger', store, date.key()):
+            return aggregate(connection)
+    finally:
+        connection.close()
+
+
+# replaces the rows for a month, unless they came from the same files. the
+# month is swapped out in a single transaction, so it's all or nothing
+def ingest(connection, store, date, paths, version, entries):
+    key = cache.fingerprint(paths, version)
+    month = date.key()
+
+    known = connection.execute('select fingerprint from ingested where store = ? and month = ?',
+                               (store, month)).fetchone()
+    if known is not None and known[0] == key:
+        return
+
+    with instrument.stage('ingest', store, month):
+        with connection:
+            # take the write lock right away, instead of when we first write
+            connection.execute('begin immediate')
+            connection.execute('delete from transactions where store = ? and month = ?', (store, month))
+
+            ids = {'products': dict(), 'types': dict(), 'currencies': dict()}
+
+            def idOf(table, value):
+                if value is None:
+                    return None
+                found = ids[table].get(value)
+                if found is None:
+                    column = 'code' if table == 'currencies' else 'name'
+                    connection.execute(f'insert or ignore into {table} ({column}) values (?)', (value,))
+                    found = connection.execute(f'select id from {table} where {column} = ?', (value,)).fetchone()[0]
+                    ids[table][value] = found
+                return found
+
+            rows = ((store, month, seq, idOf('products', entry.product), idOf('types', entry.type),
+                     entry.country, idOf('currencies', entry.currency), entry.quantity,
+                     units(entry.amount), units(entry.paid))
+                    for seq, entry in enumerate(entries()))
+            connection.executemany('insert into transactions values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+            connection.execute('insert or replace into ingested values (?, ?, ?)', (store, month, key))
+
+
+# sums up the rows for a month, grouped on the given columns, in the order
+# the groups were first seen. returns the values of the columns for each
+# group, followed by the quantity, amount and paid
+def totals(connection, store, date, groups, type=None):
+    query = f'select {"".join(group + ", " for group in groups)}sum(quantity), sum(amount), sum(paid) '
+    query += 'from entries where store = ? and month = ?'
+    arguments = [store, date.key()]
+    if type is not None:
+        query += ' and type = ?'
+        arguments.append(type)
+    if len(groups) > 0:
+        query += f' group by {", ".join(groups)} order by min(seq)'
+
+    for row in connection.execute(query, arguments):
+        yield row[:-3] + (row[-3], decimal(row[-2]), decimal(row[-1]))
+
+
+# answers questions across months and stores. filters maps columns to the
+# value they need to have, months is an optional (first, last) range of
+# month keys, and the totals are grouped on the columns in by. amounts in
+# different currencies are never added up, so currency is always grouped on
+def query(connection, filters, months=None, by=()):
+    groups = [column for column in by if column != 'currency'] + ['currency']
+
+    where = []
+    arguments = []
+    for column, value in filters.items():
+        where.append(f'{column} = ?')
+        arguments.append(value)
+    if months is not None:
+        where.append('month between ? and ?')
+        arguments += list(months)
+
+    query = f'select {", ".join(groups)}, count(*), sum(quantity), sum(amount), sum(paid) from entries'
+    if len(where) > 0:
+        query += ' where ' + ' and '.join(where)
+    query += f' group by {", ".join(groups)} order by {", ".join(groups)}'
+
+    rows = []
+    for row in connection.execute(query, arguments):
+        paid = decimal(row[-1]) if row[-1] is not None else None
+        rows.append(row[:-2] + (decimal(row[-2]), paid))
+    return groups + ['rows', 'quantity', 'amount', 'paid'], rows
@@ -0,0 +1,145 @@
+import itertools
+from typing import NamedTuple
+from utils import MergedReport
+import backends
+import instrument
+
+# the kinds of rollups taxman.py --rollup can make
+kinds = ['quarter', 'year', 'ytd', 'range']
+
+
+# a span of months that is summed up into one report. it goes where the month
+# usually does, in the report title and the file name, so it has a key() like
+# TaxMonth does
+class Period(NamedTuple):
+    label: str
+    dates: list
+
+    def key(self):
+        return self.label
+
+
+# the fiscal year a month is in (named after the year it starts in), and how
+# many months into that year it is, starting from 0
+def fiscal(date, start):
+    year = int(date.year)
+    if int(date.month) < start:
+        year -= 1
+    return year, (int(date.month) - start) % 12
+
+
+# the periods of the given kinds that dates covers, start is the month the
+# fiscal year starts in. quarters and years are only made when all their
+# months are in dates, ytd runs from the start of the last fiscal year (or the
+# first date, if that's later) up to the last date
+def periods(kinds, dates, start):
+    output = []
+    if len(dates) == 0:
+        return output
+
+    # the dates in each fiscal year, in order
+    years = dict()
+    for date in dates:
+        year, index = fiscal(date, start)
+        years.setdefault(year, []).append(date)
+
+    for kind in kinds:
+        if kind == 'quarter':
+            for year, yearDates in years.items():
+                quarters = dict()
+                for date in yearDates:
+                    quarters.setdefault(fiscal(date, start)[1] // 3, []).append(date)
+                for quarter, quarterDates in quarters.items():
+                    if len(quarterDates) == 3:
+                        output.append(Period(f'{year}-Q{quarter + 1}', quarterDates))
+
+        elif kind == 'year':
+            for year, yearDates in years.items():
+                if len(yearDates) == 12:
+                    output.append(Period(f'{year}', yearDates))
+
+        elif kind == 'ytd':
+            year = fiscal(dates[-1], start)[0]
+            output.append(Period(f'{year}-ytd-{dates[-1].key()}', years[year]))
+
+        elif kind == 'range':
+            output.append(Period(f'{dates[0].key()}..{dates[-1].key()}', dates))
+
+    return output
+
+
+# the rollups of every enabled store, as (period, report) pairs like
+# taxman.streams. the months are summed up from their aggregates, which come
+# from the cache, so only months that changed since the last run are parsed
+# with months set, only the periods that include one of those month keys
+def streams(config, dates, kinds, months=None):
+    start = int(config['output'].get('fiscal_year_start', 1))
+    selected = periods(kinds, dates, start)
+    if months is not None:
+        selected = [period for period in selected if any(date.key() in months for date in period.dates)]
+
+    output = dict()
+    for backend in backends.enabled(config):
+        output[backend.name] = rollups(backend, config, selected)
+
+    for name, store, playpass in backends.merged(backends.enabled(config)):
+        del output[store.name]
+        del output[playpass.name]
+        output[name] = merged(config, store, playpass, selected, dates)
+
+    return output
+
+
+def rollups(backend, config, periods):
+    for period in periods:
+        report = rollup(backend, config, period.dates, period)
+        if report is not None:
+            yield period.key(), report
+
+
+# sums up the months of a store into one report, months without data are left
+# out, and the ones with data are added to found. None if no month has data
+def rollup(backend, config, dates, period, found=None):
+    if found is None:
+        found = []
+
+    # the months are read one at a time, as the store adds them up
+    def months():
+        for date in dates:
+            aggregates = backend.aggregates(config, date)
+            if aggregates is not None:
+                found.append(date)
+                yield aggregates
+
+    months = months()
+    first = next(months, None)
+    if first is None:
+        return None
+
+    with instrument.stage('rollup', backend.name, period.key()):
+        report = backend.rollup(config, itertools.chain([first], months), period)
+    report.provisional = any(backend.provisional(config, date) for date in found)
+    return report
+
+
+# the google play store and play pass rollups that are paid out together. as
+# with the monthly reports, each store month goes with the play pass month
+# before it, as long as that month is one of the dates
+def merged(config, store, playpass, periods, dates):
+    adjustTaxMonth = playpass.load().adjustTaxMonth
+    keys = {date.key() for date in dates}
+
+    for period in periods:
+        found = []
+        storeReport = rollup(store, config, period.dates, period, found)
+        if storeReport is None:
+            continue
+
+        passDates = [adjustTaxMonth(date, -1) for date in found]
+        passDates = [date for date in passDates if date.key() in keys]
+        passReport = rollup(playpass, config, passDates, period)
+
+        first = adjustTaxMonth(found[0], +1)
+        last = adjustTaxMonth(found[-1], +1)
+        heading = f'Report for Google Play {period.key()} as paid on {first.key()} to {last.key()}'
+        yield period.key(), MergedReport(first, storeReport, passReport, heading)
@@ -1,108 +1,539 @@
 import configparser
-import googleplay
-import googleplaypass
-import itunes
+import backends
 import os.path
 from os.path import exists as file_exists
 import argparse
-from collections import defaultdict
+import hashlib
+import json
+import multiprocessing
+import sys
+import threading
+import time
+from collections import deque
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from queue import Queue
 from utils import TaxMonth
+from utils import MissingInput
+from utils import Report
+from utils import ReportSection
+from utils import ReportLine
+import instrument
+import ledger
+import rollups
+import tmpcache
+import watch
 
-if not os.path.isfile('taxman.cfg'):
-    exit('Error: Config file (taxman.cfg) missing, please create it')
 
-parser = argparse.ArgumentParser(
-    description='Retrieve and summarize sales data between dates.')
-parser.add_argument(
-    'start',
-    help='The first month to retrieve in the format YYYYMM')
-parser.add_argument(
-    'end',
-    help='The last month to retrieve in the format YYYYMM (optional)',
-    nargs='?')
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        description='Retrieve and summarize sales data between dates.')
+    parser.add_argument(
+        'start',
+        help='The first month to retrieve in the format YYYYMM')
+    parser.add_argument(
+        'end',
+        help='The last month to retrieve in the format YYYYMM (optional)',
+        nargs='?')
+    parser.add_argument(
+        '--jobs',
+        help='Parse this many months at the same time, in separate processes',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--profile',
+        help='Print how much time and io went to each stage of the run',
+        action='store_true')
+    parser.add_argument(
+        '--trace',
+        help='With --profile, also write every stage per store and month to this json file')
+    parser.add_argument(
+        '--rollup',
+        help='Also sum the months up into reports per fiscal quarter, fiscal year, fiscal year to date, '
+             'or the whole range',
+        nargs='+',
+        choices=rollups.kinds,
+        default=[])
+    parser.add_argument(
+        '--watch',
+        help='Keep running, and redo the reports for any month whose files change',
+        action='store_true')
+    parser.add_argument(
+        '--interval',
+        help='With --watch, how often to look for changed files, in seconds',
+        type=float,
+        default=5)
+    parser.add_argument(
+        '--poll-bucket',
+        help='With --watch, also check the Google Play bucket for new reports this often, in minutes',
+        type=float)
 
-args = parser.parse_args()
+    args = parser.parse_args()
 
-# if no end month is supplied, use the start month
-if args.end is None:
-    args.end = args.start
+    # if no end month is supplied, use the start month
+    if args.end is None:
+        args.end = args.start
 
-dates = []
+    return args
 
-startyear = int(args.start[:4])
-endyear = int(args.end[:4])
 
-for year in range(startyear, endyear + 1):
-    startmonth = 1
-    endmonth = 12
+def parseDates(start, end):
+    dates = []
 
-    if year == startyear:
-        startmonth = int(args.start[-2:])
-    if year == endyear:
-        endmonth = int(args.end[-2:])
+    startyear = int(start[:4])
+    endyear = int(end[:4])
 
-    if startmonth < 1 or startmonth > 12:
-        exit('Error: Starting month range invalid: ' + str(startmonth))
+    for year in range(startyear, endyear + 1):
+        startmonth = 1
+        endmonth = 12
 
-    if endmonth < 1 or endmonth > 12:
-        exit('Error: End month range invalid: ' + str(endmonth))
+        if year == startyear:
+            startmonth = int(start[-2:])
+        if year == endyear:
+            endmonth = int(end[-2:])
 
-    for month in range(startmonth, endmonth + 1):
-        dates.append(TaxMonth(str(year), str(month).zfill(2)))
+        if startmonth < 1 or startmonth > 12:
+            exit('Error: Starting month range invalid: ' + str(startmonth))
 
-config = configparser.ConfigParser()
-config.read('taxman.cfg')
+        if endmonth < 1 or endmonth > 12:
+            exit('Error: End month range invalid: ' + str(endmonth))
 
-outPath = config['output']['path'].rstrip('/\\')
-if not os.path.exists(outPath):
-    os.makedirs(outPath)
+        for month in range(startmonth, endmonth + 1):
+            dates.append(TaxMonth(str(year), str(month).zfill(2)))
 
-output = defaultdict(dict)
+    return dates
 
-if config['appstore']['enabled'] == 'true':
-    output['app store'] = itunes.get(config['appstore'], dates)
 
-if config['google']['enabled'] == 'true':
-    output['google play store'] = googleplay.get(config['google'], dates)
+# each task is a (date, function, arguments) tuple, the function parses a
+# single month. yields the month and its report as they are done, in the same
+# order as the tasks, leaving out months without a report. with a process pool
+# a few months are parsed ahead, but never more than twice the number of jobs
+def parseAll(tasks, pool, jobs):
+    if pool is None:
+        for date, function, arguments in tasks:
+            report = function(*arguments)
+            if report is not None:
+                yield date.key(), report
+        return
 
-if config['google']['play_pass_enabled'] == 'true':
-    output['google play pass'] = googleplaypass.get(config['google'], dates, config['packages'])
+    pending = deque()
+    tasks = iter(tasks)
+    while True:
+        for date, function, arguments in tasks:
+            # the workers have their own copy of the instrumentation, so they
+            # send back what they recorded along with the result
+            if instrument.enabled:
+                pending.append((date, pool.submit(instrument.run, function, *arguments)))
+            else:
+                pending.append((date, pool.submit(function, *arguments)))
+            if len(pending) >= jobs * 2:
+                break
 
-if config['google']['enabled'] == 'true' and config['google']['play_pass_enabled'] == 'true':
-    output['google play'] = googleplaypass.merge(output['google play store'], output['google play pass'])
-    del output['google play store']
-    del output['google play pass']
+        if not pending:
+            return
 
-for platform, platformData in output.items():
+        date, future = pending.popleft()
+        report = future.result()
+        if instrument.enabled:
+            report, recorded = report
+            instrument.extend(recorded)
+        if report is not None:
+            yield date.key(), report
+
+
+def main():
+    if not os.path.isfile('taxman.cfg'):
+        exit('Error: Config file (taxman.cfg) missing, please create it')
+
+    args = parseArgs()
+    dates = parseDates(args.start, args.end)
+    instrument.enabled = args.profile
+
+    config = configparser.ConfigParser()
+    config.read('taxman.cfg')
+
+    outPath = config['output']['path'].rstrip('/\\')
+    if not os.path.exists(outPath):
+        os.makedirs(outPath)
+
+    manifest = loadManifest(outPath)
+    finished = False
+    # with more than one account, the payouts of every report, for the totals
+    payouts = dict() if len({backend.account for backend in backends.enabled(config)}) > 1 else None
+
+    try:
+        with processPool(args.jobs) if args.jobs > 1 else nullcontext() as pool:
+            # every store downloads in the background, while the months that are
+            # here get parsed, rendered and written one at a time. so only the
+            # months being worked on are held in memory, however long the range is
+            output = streams(config, dates, pool, args.jobs)
+            if payouts is not None:
+                output = {platform: recorded(platform, reports, payouts) for platform, reports in output.items()}
+            for platform, report in interleave(output):
+                writeAll(config, outPath, platform, [report], manifest)
+
+            # the rollups are made from the months that were just parsed
+            for platform, reports in rollups.streams(config, dates, args.rollup).items():
+                if payouts is not None:
+                    reports = recorded(platform, reports, payouts)
+                writeAll(config, outPath, platform, reports, manifest)
+
+            if payouts is not None:
+                writeAll(config, outPath, 'all accounts', totals(payouts), manifest)
+        finished = True
+    except MissingInput as e:
+        print(e)
+        if not args.watch:
+            exit()
+    finally:
+        saveManifest(outPath, manifest)
+
+    tidy(config)
+
+    if args.watch:
+        def write(platform, reports):
+            if payouts is not None:
+                reports = recorded(platform, reports, payouts)
+            writeAll(config, outPath, platform, reports, manifest)
+            if payouts is not None:
+                writeAll(config, outPath, 'all accounts', totals(payouts), manifest)
+            saveManifest(outPath, manifest)
+
+        poll = args.poll_bucket * 60 if args.poll_bucket is not None else None
+        watch.run(config, dates, args.rollup, args.interval, poll, write, finished)
+
+    if args.profile:
+        print()
+        print(instrument.summarize())
+        if args.trace:
+            instrument.save(args.trace)
+
+
+# the workers are started while the downloads are running, a plain fork would
+# take along the pipes of any gcloud being started right then, and that call
+# would wait for the worker to close them, forever. so where we can, they are
+# forked from a clean process instead
+def processPool(jobs):
+    context = None
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=context)
+
+
+# the reports of every enabled store, as (month, report) pairs that are parsed
+# as they are asked for
+def streams(config, dates, pool, jobs):
+    output = dict()
+
+    for backend in backends.enabled(config):
+        print(backend.title)
+        fetched = fetchAhead(backend, config, dates, jobs * 2)
+        output[backend.name] = backend.reports(config, fetched, lambda tasks: parseAll(tasks, pool, jobs))
+
+    for name, store, playpass in backends.merged(backends.enabled(config)):
+        output[name] = playpass.load().merge(output.pop(store.name), output.pop(playpass.name))
+
+    return output
+
+
+# takes turns between the streams, a report at a time, so the stores of every
+# account are parsed side by side rather than one after the other. yields
+# (platform, (month, report)) as each one is done
+def interleave(output):
+    turns = deque(output.items())
+    while turns:
+        platform, reports = turns.popleft()
+        report = next(reports, None)
+        if report is None:
+            continue
+        turns.append((platform, reports))
+        yield platform, report
+
+
+# passes the reports on, noting the payout of each in payouts, as month ->
+# platform -> (payout, provisional)
+def recorded(platform, reports, payouts):
+    for month, report in reports:
+        payouts.setdefault(month, dict())[platform] = report.payout, report.provisional
+        yield month, report
+
+
+# one report per month (or rollup) with what every store and account paid out
+# and the sum of it, see recorded
+def totals(payouts):
+    for month in sorted(payouts):
+        lines = [ReportLine(platform, payout) for platform, (payout, provisional) in sorted(payouts[month].items())]
+        payout = sum((line.amount for line in lines), Decimal(0))
+        provisional = any(flag for amount, flag in payouts[month].values())
+        yield month, Report(f'Payout report for all accounts {month}', [ReportSection(None, lines)], payout,
+                            provisional)
+
+
+# starts downloading the months for a store in a thread of its own, and returns
+# the months in order, each one as soon as it has been fetched. the fetched
+# months are handed over in a queue that holds at most ahead months. only the
+# hand-over waits when it's full, the stores start every download up front
+# (download_workers at a time), so a long range still fetches everything
+# while the parsing catches up
+def fetchAhead(backend, config, dates, ahead):
+    queue = Queue(maxsize=max(ahead, 2))
+    errors = []
+
+    def produce():
+        try:
+            backend.fetch(config, dates, queue.put)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            # tells the other end there is nothing more coming
+            queue.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    return arrivals(queue, dates, errors)
+
+
+def arrivals(queue, dates, errors):
+    fetched = set()
+    done = False
+
+    for date in dates:
+        # the stores hand the months over in order, but keep any that come
+        # early rather than lose them
+        while date not in fetched and not done:
+            date_fetched = queue.get()
+            if date_fetched is None:
+                done = True
+            else:
+                fetched.add(date_fetched)
+
+        if errors:
+            raise errors[0]
+
+        # a month that failed to download still goes on, parsing it
+        # will tell that there's no data for it
+        fetched.discard(date)
+        yield date
+
+
+def writeAll(config, outPath, platform, reports, manifest):
     platformPath = f'{outPath}/{platform}'
     if not os.path.exists(platformPath):
         os.makedirs(platformPath)
 
-    for month, monthData in platformData.items():
+    for month, report in reports:
         path = f'{platformPath}/{month}.txt'
+        # the stores hand us the numbers, this is where they become text
+        with instrument.stage('render', platform, month):
+            monthData = report.render()
 
-        # to make things easier below, we create the output file here, if it does not already exist
-        if not file_exists(path): 
-            with open(path, 'x') as f:
-                f.write('')
-
-        # then we can open it in read+ mode, which allows us to also write if we need to
-        # there is no mode that will do this AND create the file if it doesn't exist
-        with open(path, 'r+') as f:
-            old_report = f.read()
-
-            if config['output']['overwrite'] == 'false' and old_report != monthData and old_report != "" : 
-                print(f'{path} was already generated and is different from generated report, will not overwrite')
-            elif config['output']['overwrite'] == 'false' and old_report == monthData : 
-                # generated report was same as already present report, do nothing
-                print(f'{path} was already generated and is identical to generated report')
-            else :
-                # seek to beginning of file again (because we read)
-                f.seek(0)
-                f.write(monthData)
-                # finally truncate, should this new report be shorter
-                f.truncate()
-                print(f'{path} written')
+        with instrument.stage('write', platform, month) as record:
+            writeReport(config, path, monthData, manifest, record, report.provisional)
 
         if config['output']['verbose'] == 'true':
             print(monthData)
+
+
+# the manifest remembers the hash of every report we wrote, along with the size
+# and modification time the file had afterwards. as long as the file still has
+# those, we know what's in it without reading it back
+def manifestPath(outPath):
+    return os.path.join(outPath, '.manifest.json')
+
+
+def loadManifest(outPath):
+    try:
+        with open(manifestPath(outPath)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def saveManifest(outPath, manifest):
+    path = manifestPath(outPath)
+    with open(path + '.part', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.part', path)
+
+
+def hashReport(text):
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+# returns the hash of what's in the file now, or None if there is no file
+def currentHash(path, manifest, record):
+    if not file_exists(path):
+        return None
+
+    stat = os.stat(path)
+    entry = manifest.get(path)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return entry['hash']
+
+    # the file is new to us, or was changed by someone else, so read it
+    with open(path) as f:
+        old_report = f.read()
+    record.bytes_read += len(old_report)
+    return hashReport(old_report)
+
+
+# a provisional report is written like any other, but the manifest remembers
+# it, so the final one can replace it even with overwrite turned off, as long
+# as nobody changed the file in between
+def writeReport(config, path, monthData, manifest, record, provisional=False):
+    new_hash = hashReport(monthData)
+    old_hash = currentHash(path, manifest, record)
+    entry = manifest.get(path)
+    replaceable = entry is not None and entry.get('provisional', False) and entry['hash'] == old_hash
+
+    if old_hash == new_hash:
+        # generated report was same as already present report, do nothing
+        if config['output']['overwrite'] == 'false':
+            print(f'{path} was already generated and is identical to generated report')
+        else:
+            print(f'{path} is unchanged')
+    elif (config['output']['overwrite'] == 'false' and old_hash is not None and old_hash != hashReport('')
+          and not replaceable):
+        print(f'{path} was already generated and is different from generated report, will not overwrite')
+        return
+    else:
+        # write to a temporary file and move that into place, so the report
+        # is never half written
+        with open(path + '.part', 'w') as f:
+            f.write(monthData)
+        os.replace(path + '.part', path)
+        record.bytes_written += len(monthData)
+        print(f'{path} written')
+
+    if provisional:
+        print(f'\t⚠️ {path} may still change, some of it is in a store report that is not out yet')
+
+    stat = os.stat(path)
+    manifest[path] = {'hash': new_hash, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if provisional:
+        manifest[path]['provisional'] = True
+
+
+def parseQueryArgs(arguments):
+    parser = argparse.ArgumentParser(
+        prog='taxman.py query',
+        description='Sum up the transactions in the ledger (see the ledger option in taxman.cfg).')
+    for column in ledger.columns:
+        if column != 'month':
+            parser.add_argument(
+                f'--{column}',
+                help=f'Only count transactions with this {column}')
+    parser.add_argument(
+        '--from',
+        dest='start',
+        help='The first month to count in the format YYYYMM')
+    parser.add_argument(
+        '--to',
+        dest='end',
+        help='The last month to count in the format YYYYMM (defaults to the first)')
+    parser.add_argument(
+        '--by',
+        help='Give a total for each of these, the totals are always per currency',
+        nargs='+',
+        choices=ledger.columns,
+        default=[])
+
+    args = parser.parse_args(arguments)
+
+    if args.end is None:
+        args.end = args.start
+
+    return args
+
+
+# taxman.py query --product holedown --country DE --from 202307 --to 202309
+def query(arguments):
+    args = parseQueryArgs(arguments)
+
+    filters = {column: getattr(args, column) for column in ledger.columns
+               if column != 'month' and getattr(args, column) is not None}
+    months = None
+    if args.start is not None:
+        months = (TaxMonth(args.start[:4], args.start[-2:]).key(), TaxMonth(args.end[:4], args.end[-2:]).key())
+
+    started = time.perf_counter()
+    connection = ledger.connect()
+    header, rows = ledger.query(connection, filters, months, args.by)
+    connection.close()
+
+    text = [[formatValue(value) for value in row] for row in rows]
+    widths = [max([len(name)] + [len(row[index]) for row in text]) for index, name in enumerate(header)]
+
+    print('  '.join(name.ljust(width) for name, width in zip(header, widths)))
+    for row in text:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+    print(f'\n{len(rows)} rows in {(time.perf_counter() - started) * 1000:.1f} ms')
+
+
+def formatValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, Decimal):
+        return f'{value:.2f}'
+    return str(value)
+
+
+# compresses closed months and keeps tmp under its size limit, see tmpcache
+def tidy(config):
+    actions = tmpcache.prune(config)
+    if len(actions) > 0:
+        print(tmpcache.summarize(actions))
+
+
+def parseCacheArgs(arguments):
+    parser = argparse.ArgumentParser(
+        prog='taxman.py cache',
+        description='Show what is in tmp, or compress and remove files there '
+                    '(see the [cache] section in taxman.cfg).')
+    parser.add_argument(
+        'action',
+        choices=['stats', 'prune'])
+    parser.add_argument(
+        '--dry-run',
+        help='With prune, only list what would be done',
+        action='store_true')
+
+    return parser.parse_args(arguments)
+
+
+# taxman.py cache stats, taxman.py cache prune --dry-run
+def cache(arguments):
+    args = parseCacheArgs(arguments)
+
+    config = configparser.ConfigParser()
+    config.read('taxman.cfg')
+    options = tmpcache.settings(config)
+
+    if args.action == 'prune':
+        actions = tmpcache.prune(config, args.dry_run)
+        for action, path, size in actions:
+            print(f'{action.ljust(10)} {tmpcache.megabytes(size).rjust(10)}  {path}')
+        print(tmpcache.summarize(actions, args.dry_run))
+        return
+
+    kinds, oldest = tmpcache.stats(config)
+    files = sum(count for count, size in kinds.values())
+    total = sum(size for count, size in kinds.values())
+    limit = tmpcache.megabytes(options['max_size']) if options['max_size'] > 0 else 'no limit'
+    if options['max_size'] > 0:
+        limit += ', the ledger and manifests not counted'
+    print(f'tmp holds {tmpcache.megabytes(total)} in {files} files ({limit})')
+    for kind, (count, size) in sorted(kinds.items()):
+        print(f'  {kind.ljust(30)} {str(count).rjust(6)} {tmpcache.megabytes(size).rjust(10)}')
+    if oldest is not None:
+        print(f'the least recently used file was last used on {time.strftime("%Y-%m-%d", time.localtime(oldest))}')
+
+
+# the process pool imports this file in every worker, so only run when started directly
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['query']:
+        query(sys.argv[2:])
+    elif sys.argv[1:2] == ['cache']:
+        cache(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,269 @@
+import datetime
+import gzip
+import os
+import os.path
+import re
+import shutil
+import time
+import backends
+from utils import chunkThreshold
+from utils import downloadPath
+
+# tmp holds everything we download and parse, this keeps it from growing
+# forever. the csv reports of closed months are kept gzipped, and once tmp
+# goes over max_size_mb (or a file hasn't been used in max_age_days) the
+# files used longest ago are removed. anything removed is downloaded or
+# parsed again the next time it's needed
+#
+# only the reports in the download folders and the parsed months in the
+# cache are ever touched, anything else in tmp was put there by someone else
+tmp_path = 'tmp'
+cache_path = os.path.join(tmp_path, 'cache')
+
+# the google play zips and the csvs extracted from them, like
+# earnings_202303_1.zip and earnings202303-1.csv, see googleplay.extract
+google_names = re.compile(r'(play_pass_earnings|earnings)_?(\d{6})([-_].*)?\.(zip|csv|csv\.gz)')
+# the app store reports, see itunes.filename
+apple_names = re.compile(r'itunes_\d{4}-\d{2}\.csv(\.gz)?')
+
+# the ledger holds every month ever parsed and the fetch manifests say what
+# the downloads are, these are never removed
+kept = ['ledger.sqlite', 'ledger.sqlite-wal', 'ledger.sqlite-shm', 'fetched']
+
+
+# the settings from the [cache] section, which is optional
+def settings(config):
+    section = config['cache'] if config.has_section('cache') else dict()
+    return {
+        'max_size': float(section.get('max_size_mb', 0)) * 1024 * 1024,
+        'max_age': float(section.get('max_age_days', 0)) * 24 * 60 * 60,
+        'closed_after': int(section.get('closed_after_months', 3)),
+    }
+
+
+# the path a file in tmp is at now, it may have been compressed since it was
+# written. returns path as it is if there is no such file
+def find(path):
+    if not os.path.exists(path) and os.path.exists(path + '.gz'):
+        return path + '.gz'
+    return path
+
+
+# opens a file in tmp, unpacking it as it's read if it was compressed, and
+# marks it as used. mode is 'r' for text or 'rb' for bytes
+def openFile(path, mode='r'):
+    touch(path)
+    if path.endswith('.gz'):
+        if mode == 'rb':
+            return gzip.open(path, 'rb')
+        return gzip.open(path, 'rt', encoding='utf8', newline='')
+    if mode == 'rb':
+        return open(path, 'rb')
+    return open(path, encoding='utf8', newline='')
+
+
+# marks a file as used just now, the access time is set by hand as most
+# systems only update it now and then, if at all. the modification time is
+# left alone, the cache fingerprints depend on it
+def touch(path):
+    try:
+        stat = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+    except OSError:
+        pass
+
+
+# the folders every account downloads to, as folder -> the size a google play
+# month can be before it's parsed in chunks (None if no google account uses it)
+def folders(config):
+    found = dict()
+    for backend in backends.accounts(config):
+        folder = downloadPath(config[backend.section])
+        found.setdefault(folder, None)
+        if backend.module == 'googleplay':
+            found[folder] = chunkThreshold(config[backend.section])
+    return found
+
+
+# every file that may be compressed or removed, as (group, path, stat). the
+# files in a group are only ever removed together, a month's google play zips
+# go with the csvs extracted from them, or the zips would be downloaded again
+# just to be extracted. the report folder is never touched, even if it's in tmp
+def files(config):
+    output = os.path.abspath(config['output']['path']) if config.has_section('output') else None
+
+    def candidates():
+        for folder in folders(config):
+            if not os.path.isdir(folder):
+                continue
+            for name in sorted(os.listdir(folder)):
+                found = google_names.fullmatch(name)
+                if found is not None:
+                    yield os.path.join(folder, found.group(1) + found.group(2)), os.path.join(folder, name)
+                elif apple_names.fullmatch(name):
+                    yield os.path.join(folder, name), os.path.join(folder, name)
+        for root, dirs, names in os.walk(cache_path):
+            for name in sorted(names):
+                if name.endswith('.pickle.gz'):
+                    yield os.path.join(root, name), os.path.join(root, name)
+
+    for group, path in candidates():
+        absolute = os.path.abspath(path)
+        if output is not None and (absolute == output or absolute.startswith(output + os.sep)):
+            continue
+        if os.path.isfile(path):
+            yield group, path, os.stat(path)
+
+
+# what a file in tmp is, for the stats. named accounts download into their
+# own folders, see utils.downloadPath
+def kind(path):
+    if path.startswith(cache_path + os.sep):
+        return 'parsed months'
+    if path.endswith('.zip'):
+        return 'downloaded zips'
+    if path.endswith('.csv'):
+        return 'reports'
+    if path.endswith('.csv.gz'):
+        return 'compressed reports'
+    return 'other'
+
+
+# the year and month a report is for, from its name, or None
+def month(path):
+    found = re.search(r'(\d{4})-?(\d{2})', os.path.basename(path))
+    if found is None:
+        return None
+    return int(found.group(1)), int(found.group(2))
+
+
+# a month is closed once this many months have started after it, the stores
+# don't change their reports after that
+def closed(path, after, today=None):
+    found = month(path)
+    if found is None:
+        return False
+    today = today or datetime.date.today()
+    return (today.year * 12 + today.month) - (found[0] * 12 + found[1]) >= after
+
+
+# the name, size and modification time a file had before it was compressed,
+# so the cache and the ledger don't take a compressed month for a changed one.
+# compress keeps the time, and gzip keeps the size (modulo 4 GB) in its last
+# four bytes
+def original(path):
+    stat = os.stat(path)
+    if not path.endswith('.gz'):
+        return path, stat.st_size, stat.st_mtime_ns
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        size = int.from_bytes(f.read(4), 'little')
+    return path[:-len('.gz')], size, stat.st_mtime_ns
+
+
+# gzips a report next to itself and removes the original. the times are
+# kept, so the file doesn't look like it was just used
+def compress(path, stat):
+    with open(path, 'rb') as src, gzip.open(path + '.gz.part', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.utime(path + '.gz.part', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(path + '.gz.part', path + '.gz')
+    os.remove(path)
+
+
+# compresses the reports of closed months, then removes files that haven't
+# been used in max_age, then the ones used longest ago until tmp fits in
+# max_size. with dryRun nothing is touched. returns what was (or would be)
+# done, as (action, path, bytes) tuples
+def prune(config, dryRun=False):
+    options = settings(config)
+    thresholds = folders(config)
+    actions = []
+
+    found = list(files(config))
+
+    # google play months too big to fit under the chunk threshold are left as
+    # they are, the chunked parser needs to seek in the csv
+    sizes = dict()
+    for group, path, stat in found:
+        if path.endswith('.csv') or path.endswith('.csv.gz'):
+            sizes[group] = sizes.get(group, 0) + stat.st_size
+
+    groups = dict()
+    for group, path, stat in found:
+        threshold = thresholds.get(os.path.dirname(path))
+        chunked = (threshold is not None and google_names.fullmatch(os.path.basename(path)) is not None
+                   and sizes[group] > threshold)
+        if path.endswith('.csv') and not chunked and closed(path, options['closed_after']):
+            actions.append(('compressed', path, stat.st_size))
+            if not dryRun:
+                compress(path, stat)
+                path += '.gz'
+                stat = os.stat(path)
+        groups.setdefault(group, []).append((path, stat))
+
+    # a group was last used when any of its files was, used longest ago first
+    remaining = sorted(groups.values(), key=lambda members: max(stat.st_atime_ns for path, stat in members))
+    # the ledger and the manifests are never removed, so they don't count
+    # towards max_size, or a big ledger would have everything else removed
+    total = sum(stat.st_size for members in remaining for path, stat in members)
+    now = time.time()
+
+    for members in remaining:
+        used = max(stat.st_atime for path, stat in members)
+        tooOld = options['max_age'] > 0 and now - used > options['max_age']
+        tooBig = options['max_size'] > 0 and total > options['max_size']
+        if not tooOld and not tooBig:
+            continue
+        for path, stat in members:
+            actions.append(('removed', path, stat.st_size))
+            total -= stat.st_size
+            if not dryRun:
+                os.remove(path)
+
+    return actions
+
+
+# the files in tmp that are never removed, as (path, bytes)
+def keptFiles():
+    for name in kept:
+        path = os.path.join(tmp_path, name)
+        if os.path.isfile(path):
+            yield path, os.path.getsize(path)
+        elif os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                for filename in names:
+                    yield os.path.join(root, filename), os.path.getsize(os.path.join(root, filename))
+
+
+# what's in tmp, as a dictionary of kind -> [files, bytes], and the time the
+# file used longest ago was last used (or None if there are no files)
+def stats(config):
+    kinds = dict()
+    oldest = None
+    for group, path, stat in files(config):
+        entry = kinds.setdefault(kind(path), [0, 0])
+        entry[0] += 1
+        entry[1] += stat.st_size
+        if oldest is None or stat.st_atime < oldest:
+            oldest = stat.st_atime
+
+    for path, size in keptFiles():
+        entry = kinds.setdefault('ledger and manifests (kept)', [0, 0])
+        entry[0] += 1
+        entry[1] += size
+
+    return kinds, oldest
+
+
+# one line about what prune did
+def summarize(actions, dryRun=False):
+    compressed = [size for action, path, size in actions if action == 'compressed']
+    removed = [size for action, path, size in actions if action == 'removed']
+    verb = 'Would compress' if dryRun else 'Compressed'
+    return (f'{verb} {len(compressed)} and {"remove" if dryRun else "removed"} {len(removed)} files in tmp, '
+            f'freeing {megabytes(sum(removed))} (not counting compression)')
+
+
+def megabytes(size):
+    return f'{size / 1024 / 1024:.1f} MB'
@@ -1,8 +1,52 @@
 from typing import NamedTuple
+from typing import Optional
 from decimal import Decimal
+from array import array
+import os.path
+
+merge_spacer = '\n\n--------------------------------------------------------------\n\n'
+
+# shared, Decimals can't be changed
+zero = Decimal(0)
+
+
+# raised when a month can't be parsed until someone puts a file in place
+class MissingInput(Exception):
+    pass
+
+
+# named accounts have config sections of their own, like [google:studio]
+# next to [google]. this is the account a section is for, '' for the section
+# without a name
+def account(config):
+    return getattr(config, 'name', '').partition(':')[2]
+
+
+# where an account's reports are downloaded to, named accounts get a folder
+# of their own in tmp, as the stores name their files the same for everyone
+def downloadPath(config):
+    if account(config) == '':
+        return 'tmp'
+    return os.path.join('tmp', account(config))
+
+
+# what a store goes by in the cache, the ledger and the output folder, named
+# accounts have their name in front
+def storeName(config, store):
+    if account(config) == '':
+        return store
+    return f'{account(config)}/{store}'
+
+
+# google play months with more megabytes of reports than this are split up and
+# parsed on several cores, see googleplay.bucketMonth
+def chunkThreshold(config):
+    return float(config.get('chunk_threshold_mb', 64)) * 1024 * 1024
 
 
 class TransactionCollection:
+    __slots__ = ('sum', 'count', 'paid')
+
     def __init__(self):
         self.sum = Decimal(0)
         self.count = int(0)
@@ -11,6 +55,134 @@ class TransactionCollection:
     def __str__(self):
         return f'sum: {self.sum}, count: {self.count}, paid: {self.paid}'
 
+    def add(self, other):
+        self.sum += other.sum
+        self.count += other.count
+        self.paid += other.paid
+
+
+# sums up counts and amounts per key, this is what gets cached for a month.
+# every key is given a slot the first time it's seen, and the totals live in
+# columns indexed by slot, instead of in an object per key. the parsers look
+# up the slot and add to the columns directly, that's the part that runs for
+# every row:
+#
+#   slot = accumulator.slots.get(key)
+#   if slot is None:
+#       slot = accumulator.slot(key)
+#   accumulator.counts[slot] += 1
+#   accumulator.sums[slot] += Decimal(amount)
+#
+# while parsing the sums are Decimals, the decimal module turns a string into
+# an exact number in C, faster than we can in python. once the month is done
+# freeze() turns them into whole numbers of the smallest unit seen, and they
+# only become Decimals again when a report is made, see collections()
+class Accumulator:
+    __slots__ = ('slots', 'keys', 'counts', 'sums', 'paid', 'exponent')
+
+    def __init__(self):
+        self.slots = dict()
+        self.keys = []
+        self.counts = array('q')
+        self.sums = []
+        self.paid = []
+        # the power of ten the frozen sums are counted in, None until then
+        self.exponent = None
+
+    def slot(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slots[key] = len(self.keys)
+            self.keys.append(key)
+            self.counts.append(0)
+            empty = zero if self.exponent is None else 0
+            self.sums.append(empty)
+            self.paid.append(empty)
+        return slot
+
+    def freeze(self):
+        if self.exponent is None:
+            # adding up decimals is exact and keeps the smallest exponent of
+            # the two, so the sum of everything has the smallest one of all.
+            # that's one as_tuple() instead of one per key
+            exponent = min(sum(self.sums, zero).as_tuple().exponent, sum(self.paid, zero).as_tuple().exponent, 0)
+            scale = Decimal(10) ** -exponent
+            self.sums = column(int(value * scale) for value in self.sums)
+            self.paid = column(int(value * scale) for value in self.paid)
+            self.exponent = exponent
+        return self
+
+    # the slots are left out of the cache, they're quick to find again
+    def __getstate__(self):
+        return self.keys, self.counts, self.sums, self.paid, self.exponent
+
+    def __setstate__(self, state):
+        self.keys, self.counts, self.sums, self.paid, self.exponent = state
+        self.slots = {key: slot for slot, key in enumerate(self.keys)}
+
+    # adds the totals of another frozen accumulator to this one, new keys go
+    # at the end, so adding them up in order keeps the order keys were seen
+    def add(self, other):
+        self.freeze()
+
+        # adding to an empty one is a copy, months are put together that way
+        if len(self.keys) == 0:
+            self.keys = list(other.keys)
+            self.slots = {key: slot for slot, key in enumerate(self.keys)}
+            self.counts = array('q', other.counts)
+            self.sums = column(other.sums)
+            self.paid = column(other.paid)
+            self.exponent = other.exponent
+            return self
+
+        # the columns are only scaled when the other one counts in smaller units
+        exponent = min(self.exponent, other.exponent)
+        if exponent == self.exponent:
+            sums = list(self.sums)
+            paid = list(self.paid)
+        else:
+            sums = [value * 10 ** (self.exponent - exponent) for value in self.sums]
+            paid = [value * 10 ** (self.exponent - exponent) for value in self.paid]
+        self.sums = sums
+        self.paid = paid
+        self.exponent = exponent
+
+        scale = 10 ** (other.exponent - exponent)
+        slots = self.slots
+        counts = self.counts
+        for key, count, total, paidTotal in zip(other.keys, other.counts, other.sums, other.paid):
+            slot = slots.get(key)
+            if slot is None:
+                slot = self.slot(key)
+            counts[slot] += count
+            sums[slot] += total * scale
+            paid[slot] += paidTotal * scale
+
+        self.sums = column(sums)
+        self.paid = column(paid)
+        return self
+
+    # the totals as TransactionCollections, in the order the keys were first seen
+    def collections(self):
+        self.freeze()
+        unit = Decimal(1).scaleb(self.exponent)
+        for slot, key in enumerate(self.keys):
+            collection = TransactionCollection()
+            collection.count = self.counts[slot]
+            collection.sum = Decimal(self.sums[slot]) * unit
+            collection.paid = Decimal(self.paid[slot]) * unit
+            yield key, collection
+
+
+# whole numbers go in an array, eight bytes each, unless one is too big for
+# that, then they stay python ints
+def column(values):
+    values = list(values)
+    try:
+        return array('q', values)
+    except OverflowError:
+        return values
+
 
 class TaxMonth(NamedTuple):
     year: str
@@ -20,6 +192,102 @@ class TaxMonth(NamedTuple):
         return f'{self.year}-{self.month}'
 
 
+# the month month_delta months before (or after) date
+def adjustTaxMonth(date, month_delta):
+    year = int(date.year)
+    month = int(date.month) + month_delta
+
+    while month < 1:
+        year -= 1
+        month += 12
+
+    while month > 12:
+        year += 1
+        month -= 12
+
+    return TaxMonth(str(year), str(month).zfill(2))
+
+
+class ReportLine(NamedTuple):
+    name: str
+    amount: Decimal
+    # only some lines have a unit count, the rest leave it out
+    count: Optional[int] = None
+
+
+class ReportSection(NamedTuple):
+    # the first section of a report may not have a heading
+    heading: Optional[str]
+    lines: list
+
+
+# a report holds the numbers for one store and month, it is only turned
+# into text at the very end, by render()
+class Report:
+    def __init__(self, title, sections, payout, provisional=False):
+        self.title = title
+        self.sections = sections
+        self.payout = payout
+        # the report may still change, some of what goes in it is in a store
+        # report that isn't out yet, see taxman.writeReport
+        self.provisional = provisional
+
+    def render(self):
+        text = f'{self.title}\n\n'
+
+        for index, section in enumerate(self.sections):
+            if index > 0:
+                text += '\n\n'
+            if section.heading is not None:
+                text += f'{section.heading}:\n\n'
+            for line in section.lines:
+                text += f'{line.name.ljust(25)}{format_currency(line.amount)}'
+                if line.count is not None:
+                    text += format_count(line.count)
+                text += '\n'
+
+        text += '\n\n'
+        text += 'Payout'.ljust(25) + format_currency(self.payout)
+
+        return text
+
+
+# the google play store and play pass reports that are paid out together
+# playpass may be None if there is no play pass report for that month
+# heading replaces the first line, rollups use it to list all the pay dates
+class MergedReport:
+    def __init__(self, pay_date, playstore, playpass, heading=None):
+        self.pay_date = pay_date
+        self.playstore = playstore
+        self.playpass = playpass
+        self.heading = heading
+
+    @property
+    def provisional(self):
+        return self.playstore.provisional or (self.playpass is not None and self.playpass.provisional)
+
+    @property
+    def payout(self):
+        payout = self.playstore.payout
+        if self.playpass is not None:
+            payout += self.playpass.payout
+        return payout
+
+    def render(self):
+        text = 'Report for Google Play as paid on '
+        text += f'{self.pay_date.year}-{self.pay_date.month}\n\n'
+        if self.heading is not None:
+            text = f'{self.heading}\n\n'
+
+        text += self.playstore.render() + merge_spacer
+        if self.playpass is not None:
+            text += self.playpass.render()
+
+        text += merge_spacer + 'Total Payout:'.ljust(25) + f'{format_currency(self.payout)}\n'
+
+        return text
+
+
 def format_currency(value):
     return '{:16,.2f} SEK'.format(value).replace(',', ' ').replace('.', ',')
 
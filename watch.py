@@ -0,0 +1,106 @@
+import time
+from utils import MissingInput
+import backends
+import cache
+import rollups
+
+
+# keeps an eye on the files every month is parsed from, and parses and writes
+# the months whose files changed again, along with anything that depends on
+# them. write(platform, reports) is given (month, report) pairs to write, like
+# taxman.writeAll. with poll set, the bucket is checked for new zips every
+# poll seconds. if the run before didn't finish, everything is redone first
+# runs until interrupted
+def run(config, dates, kinds, interval, poll, write, finished=True):
+    enabled = backends.enabled(config)
+    seen = fingerprints(config, dates, enabled) if finished else None
+    polled = time.monotonic()
+
+    print(f'Watching for changes every {interval} seconds, press ctrl+c to stop')
+
+    try:
+        while True:
+            if seen is not None:
+                time.sleep(interval)
+
+            # the zips are extracted as they are downloaded (or read as they
+            # are), so new ones show up as changed files below
+            if poll is not None and time.monotonic() - polled >= poll:
+                polled = time.monotonic()
+                for backend in enabled:
+                    if backend.section.partition(':')[0] == 'google':
+                        backend.fetch(config, dates)
+
+            current = fingerprints(config, dates, enabled)
+            changed = {unit for unit, key in current.items() if seen is None or seen.get(unit) != key}
+            if len(changed) > 0:
+                rebuild(config, dates, kinds, enabled, changed, write)
+
+            seen = current
+    except KeyboardInterrupt:
+        print('Stopped watching')
+
+
+# a fingerprint of the files behind every (store, month key)
+def fingerprints(config, dates, enabled):
+    return {(backend.name, date.key()): cache.fingerprint(backend.sources(config, date), 0)
+            for backend in enabled for date in dates}
+
+
+# parses and writes the changed units, and the merged google play months and
+# rollups that include them
+def rebuild(config, dates, kinds, enabled, changed, write):
+    merged = backends.merged(enabled)
+    paired = {backend.name for name, store, playpass in merged for backend in (store, playpass)}
+
+    # the months that changed for any store, to pick the rollups to redo
+    months = {month for name, month in changed}
+
+    for backend in enabled:
+        if backend.name in paired:
+            continue
+        affected = [date for date in dates if (backend.name, date.key()) in changed]
+        if len(affected) > 0:
+            print(f'{backend.title}: {", ".join(date.key() for date in affected)} changed')
+            write(backend.name, parseUnits(backend, config, affected))
+
+    for name, store, playpass in merged:
+        googleplaypass = playpass.load()
+
+        # a changed play pass month is paid out with the next store month
+        storeMonths = set()
+        for date in dates:
+            if (store.name, date.key()) in changed:
+                storeMonths.add(date.key())
+            if (playpass.name, date.key()) in changed:
+                storeMonths.add(googleplaypass.adjustTaxMonth(date, +1).key())
+        affected = [date for date in dates if date.key() in storeMonths]
+        months |= storeMonths
+
+        if len(affected) > 0:
+            print(f'{store.title}: {", ".join(date.key() for date in affected)} changed')
+            passDates = [googleplaypass.adjustTaxMonth(date, -1) for date in affected]
+            keys = {date.key() for date in dates}
+            passDates = [date for date in passDates if date.key() in keys]
+            write(name, googleplaypass.merge(parseUnits(store, config, affected),
+                                             parseUnits(playpass, config, passDates)))
+
+    for platform, reports in rollups.streams(config, dates, kinds, months).items():
+        try:
+            write(platform, reports)
+        except MissingInput as e:
+            print(f'\t⚠️ {e}')
+
+
+# parses the months for a store, in order, as (month, report) pairs. a month
+# that is missing a file is skipped, it's parsed again once the file is there
+def parseUnits(backend, config, dates):
+    for date in dates:
+        function, arguments = backend.task(config, date)
+        try:
+            report = function(*arguments)
+        except MissingInput as e:
+            print(f'\t⚠️ {e}')
+            continue
+        if report is not None:
+            yield date.key(), report